@@ -1,12 +1,14 @@
 import os
 import re
 import time
-from typing import Optional
+from asyncio import to_thread
+from typing import Callable, Optional
 
 from gigachat import GigaChat
 from gigachat.models import Chat, Messages, MessagesRole
 
-from app.storage import load_user_data, save_user_data
+from app.plan_cache import get_cached_plan, plan_cache_key, put_cached_plan
+from app.storage import cache_model_reply, flush_user_data, load_user_data
 
 GIGACHAT_MODEL: str = os.getenv("GIGACHAT_MODEL", "GigaChat-2-Max").strip()
 GIGACHAT_TEMPERATURE: float = float(os.getenv("GIGACHAT_TEMPERATURE", "0.35"))
@@ -97,65 +99,95 @@ QA_SYSTEM_PROMPT = (
 
 
 _RPE_PATTERNS = [
-    r"\(?\s*RPE\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
-    r"\(?\s*RIR\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
-    r"\bдо\s+отказа\b",
-    r"\bпочти\s+до\s+отказа\b",
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"\(?\s*RPE\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
+        r"\(?\s*RIR\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
+        r"\bдо\s+отказа\b",
+        r"\bпочти\s+до\s+отказа\b",
+    )
 ]
 
+# регулярки для _strip_noise компилируем один раз при импорте
+_RE_BULLET = re.compile(r"^\s*•\s+", re.MULTILINE)
+_RE_TIMES = re.compile(r"(\d)\s*[xX\*]\s*(\d)")
+_RE_BR = re.compile(r"\s*<br\s*/?>\s*", re.IGNORECASE)
+_RE_P = re.compile(r"</?p\s*/?>", re.IGNORECASE)
+_RE_HEADER = re.compile(r"^\s*#{1,6}\s*", re.MULTILINE)
+_RE_EMPTY_PARENS = re.compile(r"\(\s*\)")
+_RE_DOUBLE_COMMA = re.compile(r",\s*,")
+_RE_SPACES = re.compile(r"[ \t]{2,}")
+_RE_TRAILING_WS = re.compile(r"[ \t]+\n")
+_RE_LEADING_WS = re.compile(r"\n[ \t]+")
+_RE_BLANKS = re.compile(r"\n{3,}")
+_RE_DIGITS = re.compile(r"\d+")
+
 def _strip_noise(text: str) -> str:
     """Убираем RPE/RIR/«до отказа», лишние пробелы и #/## заголовки."""
     out = text or ""
     # RPE/RIR
     for p in _RPE_PATTERNS:
-        out = re.sub(p, "", out, flags=re.IGNORECASE)
+        out = p.sub("", out)
 
     # заменить маркеры • на дефисы, x/* на ×
-    out = re.sub(r"^\s*•\s+", "- ", out, flags=re.MULTILINE)
-    out = re.sub(r"(\d)\s*[xX\*]\s*(\d)", r"\1×\2", out)
+    out = _RE_BULLET.sub("- ", out)
+    out = _RE_TIMES.sub(r"\1×\2", out)
 
     # убрать HTML теги <br>, <p>
-    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
-    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
+    out = _RE_BR.sub("\n", out)
+    out = _RE_P.sub("\n", out)
 
     # убрать markdown заголовки # и ##
-    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
+    out = _RE_HEADER.sub("", out)
 
     # косметика
-    out = re.sub(r"\(\s*\)", "", out)
-    out = re.sub(r",\s*,", ", ", out)
-    out = re.sub(r"[ \t]{2,}", " ", out)
-    out = re.sub(r"[ \t]+\n", "\n", out)
-    out = re.sub(r"\n[ \t]+", "\n", out)
-    out = re.sub(r"\n{3,}", "\n\n", out)
+    out = _RE_EMPTY_PARENS.sub("", out)
+    out = _RE_DOUBLE_COMMA.sub(", ", out)
+    out = _RE_SPACES.sub(" ", out)
+    out = _RE_TRAILING_WS.sub("\n", out)
+    out = _RE_LEADING_WS.sub("\n", out)
+    out = _RE_BLANKS.sub("\n\n", out)
 
     return out.strip()
 
 def _to_int(s) -> Optional[int]:
     try:
-        return int(re.search(r"\d+", str(s)).group(0))
+        return int(_RE_DIGITS.search(str(s)).group(0))
     except Exception:
         return None
 
 
 class FitnessAgent:
-    def __init__(self, token: str, user_id: str):
+    def __init__(self, token: str, user_id: str, on_saved: Optional[Callable[[str], None]] = None):
         self.token = token
         self.user_id = user_id
-        self.user_data = load_user_data(user_id)
+        # ответ модели кладём в кэш анкеты; on_saved(user_id) планирует запись
+        # на диск (в боте — bot.user_cache.mark_dirty), без него пишем сразу
+        self._on_saved = on_saved
+        # анкету не читаем здесь: конструктор вызывают в цикле событий,
+        # а get_program/get_answer всё равно перечитывают её в потоке
+
+    def _reload_user_data(self) -> None:
+        """
+        Перечитываем анкету перед каждым запросом: агент может жить дольше одного
+        сообщения (кэш в боте), а анкета за это время — измениться.
+        Это снимок для промпта: к моменту ответа модели он мог устареть,
+        поэтому обратно пишем только поля ответа (cache_model_reply).
+        """
+        self.user_data = load_user_data(self.user_id)
 
         phys = self.user_data.get("physical_data") or {}
+        self._phys = phys
         self._user_name: Optional[str] = (phys.get("name") or "").strip() or None
 
         self._phys_prompt = self._format_physical_data(phys)
 
-
     async def get_program(self, user_instruction: str = "") -> str:
         """
         Вернёт сгенерированную программу (Markdown), с учётом анкеты.
         user_instruction — дополнительные пожелания (например: «сделай 5 дней»).
         """
-        from asyncio import to_thread
+        await to_thread(self._reload_user_data)
         payload = Chat(
             messages=[
                 Messages(role=MessagesRole.SYSTEM, content=SYSTEM_PROMPT),
@@ -194,24 +226,33 @@ class FitnessAgent:
                     time.sleep(1.5 * attempt)
             raise last_err or RuntimeError("GigaChat call failed")
 
-        txt = await to_thread(_chat_sync)
-        cleaned = _strip_noise(txt)
+        # первая программа без пожеланий — берём готовую для похожей анкеты, если есть
+        cache_key = None if user_instruction else plan_cache_key(self._phys)
+        cleaned = None
+        if cache_key is not None:
+            cleaned = await to_thread(get_cached_plan, cache_key)
+        if cleaned is None:
+            txt = await to_thread(_chat_sync)
+            cleaned = _strip_noise(txt)
+            if cache_key is not None:
+                await to_thread(put_cached_plan, cache_key, cleaned)
         final = self._with_name_prefix(cleaned)
 
-        # сохраняем в историю и как последнюю программу
-        hist = self.user_data.get("history", [])
-        hist.append(("🧍 Запрос программы", "🤖 " + final))
-        self.user_data["history"] = hist
-        self.user_data["last_program"] = final
-        self.user_data["last_reply"] = final
-        save_user_data(self.user_id, self.user_data)
+        # сохраняем в историю и как последнюю программу; пока только в кэш —
+        # на диск анкету пишет отложенная запись, которую планирует on_saved.
+        # Пишем только эти поля: self.user_data прочитана до запроса к модели и
+        # могла устареть (правка анкеты или «Начать заново» во время генерации)
+        await to_thread(
+            cache_model_reply, self.user_id, ("🧍 Запрос программы", "🤖 " + final), final, final
+        )
+        await self._persist()
         return final
 
     async def get_answer(self, question: str) -> str:
         """
         Краткий структурированный ответ/совет. Если явно просят план — можно выдать план (учитывая анкету).
         """
-        from asyncio import to_thread
+        await to_thread(self._reload_user_data)
         payload = Chat(
             messages=[
                 Messages(role=MessagesRole.SYSTEM, content=QA_SYSTEM_PROMPT),
@@ -236,15 +277,19 @@ class FitnessAgent:
         txt = await to_thread(_chat_sync)
         cleaned = _strip_noise(txt).strip()
 
-        # история
-        hist = self.user_data.get("history", [])
-        hist.append(("🧍 " + question, "🤖 " + cleaned))
-        self.user_data["history"] = hist
-        self.user_data["last_reply"] = cleaned
-        save_user_data(self.user_id, self.user_data)
+        # история (в кэш, на диск — через on_saved; только эти поля, см. get_program)
+        await to_thread(cache_model_reply, self.user_id, ("🧍 " + question, "🤖 " + cleaned), cleaned)
+        await self._persist()
         return cleaned
 
 
+    async def _persist(self) -> None:
+        if self._on_saved is not None:
+            self._on_saved(self.user_id)
+        else:
+            # без бота (скрипты, отладка) пишем анкету сразу
+            await to_thread(flush_user_data, self.user_id)
+
     def _format_physical_data(self, d: dict) -> str:
         # базовая информация
         result = (
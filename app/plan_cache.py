@@ -0,0 +1,104 @@
+"""
+Кэш первых программ для похожих анкет.
+
+Одинаковые по сути анкеты (пол, уровень, цель, частота, ограничения и близкие
+возраст/рост/вес) получают готовую программу без повторного запроса к GigaChat.
+Хранится в SQLite, запись живёт PLAN_CACHE_TTL_DAYS дней.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+PLAN_CACHE_PATH = Path(os.getenv("PLAN_CACHE_PATH", "data/plan_cache.sqlite3"))
+PLAN_CACHE_TTL_DAYS: float = float(os.getenv("PLAN_CACHE_TTL_DAYS", "7"))
+
+_NO_RESTRICTIONS = ("", "нет", "no", "-")
+
+logger = logging.getLogger("app.plan_cache")
+
+# одно соединение на процесс: схема создаётся один раз, при первом обращении.
+# к кэшу ходят из потоков to_thread — доступ к соединению под блокировкой
+_CONN: Optional[sqlite3.Connection] = None
+_CONN_LOCK = threading.Lock()
+
+
+def _bucket(value: Any, step: int) -> Optional[int]:
+    """Округляем число вниз до шага (возраст по 5 лет, вес по 5 кг и т.п.)."""
+    try:
+        return int(float(str(value).replace(",", "."))) // step * step
+    except (TypeError, ValueError):
+        return None
+
+
+def plan_cache_key(phys: Dict[str, Any]) -> str:
+    """Ключ кэша по канонизированной анкете."""
+    restrictions = str(phys.get("restrictions") or "").strip().lower()
+    if restrictions in _NO_RESTRICTIONS:
+        restrictions = ""
+    canonical = {
+        "gender": phys.get("gender"),
+        "level": phys.get("level"),
+        "target": phys.get("target"),
+        "schedule": _bucket(phys.get("schedule"), 1),
+        "muscle_group": phys.get("preferred_muscle_group"),
+        "restrictions": restrictions,
+        "age": _bucket(phys.get("age"), 5),
+        "height": _bucket(phys.get("height"), 5),
+        "weight": _bucket(phys.get("weight"), 5),
+        "goal": _bucket(phys.get("goal"), 5),
+    }
+    raw = json.dumps(canonical, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    """Общее соединение с базой; вызывать под _CONN_LOCK."""
+    global _CONN
+    if _CONN is None:
+        PLAN_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(PLAN_CACHE_PATH, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, plan TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.commit()
+        _CONN = conn
+    return _CONN
+
+
+def get_cached_plan(key: str) -> Optional[str]:
+    """Программа из кэша или None, если её нет или она устарела."""
+    min_created = time.time() - PLAN_CACHE_TTL_DAYS * 86400
+    try:
+        with _CONN_LOCK:
+            row = _connect().execute(
+                "SELECT plan FROM plans WHERE key = ? AND created >= ?", (key, min_created)
+            ).fetchone()
+    except sqlite3.Error:
+        # кэш — только ускорение: при любой проблеме с базой идём в модель
+        return None
+    return row[0] if row else None
+
+
+def put_cached_plan(key: str, plan: str) -> None:
+    """Кладёт программу в кэш и заодно удаляет устаревшие записи, чтобы база не росла."""
+    now = time.time()
+    try:
+        with _CONN_LOCK:
+            conn = _connect()
+            with conn:
+                conn.execute(
+                    "DELETE FROM plans WHERE created < ?", (now - PLAN_CACHE_TTL_DAYS * 86400,)
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO plans (key, plan, created) VALUES (?, ?, ?)",
+                    (key, plan, now),
+                )
+    except sqlite3.Error as e:
+        # программа уже отдана пользователю; но сломанный кэш должен быть виден в логах
+        logger.warning("Plan cache write failed: %s", e)
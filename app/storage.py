@@ -1,9 +1,15 @@
-import json
 import os
 import copy
+import threading
 import time
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
+
+# анкеты пишем с отступами, чтобы файлы оставались читаемыми;
+# нестроковые ключи приводим к строкам, как это делал json.dump
+_JSON_DUMP_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
 
 
 def validate_age(text: str) -> Tuple[bool, Optional[int], str]:
@@ -71,8 +77,17 @@ DEFAULT_USER_DATA: Dict[str, Any] = {
     "last_program": None,      # последняя СГЕНЕРИРОВАННАЯ ПРОГРАММА
     "physical_data_completed": False,
     "programs": [],            # опционально
+    "saved_programs": [],      # индекс файлов «💾 Сохранить ответ»: [{"ts", "filename", "file_id"?}]
+    "saved_programs_scanned": False,  # файлы, сохранённые до индекса, уже перенесены в него
+    "state": None,             # незавершённый сценарий бота (mode/step/data)
 }
 
+# сколько последних сохранённых файлов помним в индексе
+SAVED_PROGRAMS_LIMIT = 50
+# сколько последних записей истории держим в анкете: полные тексты программ
+# тяжёлые, а анкета целиком копируется в кэше и переписывается при каждой записи
+HISTORY_LIMIT = 100
+
 
 def _user_path(user_id: str, folder: str) -> Path:
     return Path(folder) / f"{user_id}.json"
@@ -91,7 +106,7 @@ def _ensure_structure(data: Dict[str, Any]) -> Dict[str, Any]:
 
     # history
     if isinstance(data.get("history"), list):
-        result["history"] = data["history"]
+        result["history"] = data["history"][-HISTORY_LIMIT:]
 
     # physical_data
     if isinstance(data.get("physical_data"), dict):
@@ -123,11 +138,70 @@ def _ensure_structure(data: Dict[str, Any]) -> Dict[str, Any]:
     if isinstance(data.get("programs"), list):
         result["programs"] = data["programs"]
 
+    # индекс сохранённых файлов
+    if isinstance(data.get("saved_programs"), list):
+        result["saved_programs"] = data["saved_programs"]
+    if isinstance(data.get("saved_programs_scanned"), bool):
+        result["saved_programs_scanned"] = data["saved_programs_scanned"]
+
+    # состояние сценария бота
+    if isinstance(data.get("state"), dict):
+        result["state"] = data["state"]
+
     return result
 
 
 
-def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+# In-memory кэш анкет: (folder, user_id) -> нормализованные данные.
+# Все функции модуля читают/пишут через load_user_data/save_user_data, поэтому кэш
+# всегда согласован с тем, что лежит (или вот-вот ляжет) на диск.
+_CACHE: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_CACHE_LOCK = threading.Lock()
+# запись одного файла не должна идти из двух потоков одновременно (общий *.tmp)
+_FILE_LOCKS: Dict[Tuple[str, str], threading.Lock] = {}
+# время последнего обращения и версии записи: анкеты, к которым не обращались
+# дольше USER_CACHE_TTL и уже записанные на диск, выкидываем из памяти
+USER_CACHE_TTL = 60.0  # секунд
+_CACHE_TOUCHED: Dict[Tuple[str, str], float] = {}
+_CACHE_VERSION: Dict[Tuple[str, str], int] = {}
+_FLUSHED_VERSION: Dict[Tuple[str, str], int] = {}
+_last_cache_sweep = 0.0
+
+
+def _cache_key(user_id: str, folder: str) -> Tuple[str, str]:
+    return folder, str(user_id)
+
+
+def _mark_changed(key: Tuple[str, str]) -> None:
+    # вызывать под _CACHE_LOCK
+    _CACHE_VERSION[key] = _CACHE_VERSION.get(key, 0) + 1
+    _CACHE_TOUCHED[key] = time.monotonic()
+
+
+def _sweep_cache() -> None:
+    """Раз в USER_CACHE_TTL выкидываем простаивающие анкеты, уже записанные на диск."""
+    global _last_cache_sweep
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        if now - _last_cache_sweep < USER_CACHE_TTL:
+            return
+        _last_cache_sweep = now
+        for key in list(_CACHE):
+            if now - _CACHE_TOUCHED.get(key, 0.0) <= USER_CACHE_TTL:
+                continue
+            if _CACHE_VERSION.get(key, 0) != _FLUSHED_VERSION.get(key, 0):
+                continue  # есть незаписанные изменения
+            file_lock = _FILE_LOCKS.get(key)
+            if file_lock is not None and file_lock.locked():
+                continue
+            del _CACHE[key]
+            _CACHE_TOUCHED.pop(key, None)
+            _CACHE_VERSION.pop(key, None)
+            _FLUSHED_VERSION.pop(key, None)
+            _FILE_LOCKS.pop(key, None)
+
+
+def _read_user_file(user_id: str, folder: str) -> Dict[str, Any]:
     """
     Безопасно читаем JSON. При ошибке парсинга/отсутствии файла — возвращаем дефолт.
     """
@@ -136,28 +210,24 @@ def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
         return copy.deepcopy(DEFAULT_USER_DATA)
 
     try:
-        with path.open("r", encoding="utf-8") as f:
-            raw = json.load(f)
-    except (json.JSONDecodeError, OSError):
+        raw = orjson.loads(path.read_bytes())
+    except (orjson.JSONDecodeError, OSError):
         return copy.deepcopy(DEFAULT_USER_DATA)
 
     return _ensure_structure(raw)
 
 
-def save_user_data(user_id: str, data: Dict[str, Any], folder: str = "data/users") -> None:
+def _write_user_file(user_id: str, data: Dict[str, Any], folder: str) -> None:
     """
     Атомарная запись через временный файл: *.tmp → os.replace.
-    Параллельно нормализуем структуру.
     """
     Path(folder).mkdir(parents=True, exist_ok=True)
-    normalized = _ensure_structure(data)
 
     path = _user_path(user_id, folder)
     tmp_path = path.with_suffix(".json.tmp")
 
     try:
-        with tmp_path.open("w", encoding="utf-8") as f:
-            json.dump(normalized, f, ensure_ascii=False, indent=4)
+        tmp_path.write_bytes(orjson.dumps(data, option=_JSON_DUMP_OPTIONS))
         os.replace(tmp_path, path)
     finally:
         # на всякий случай почистим tmp, если что-то пошло не так
@@ -168,6 +238,129 @@ def save_user_data(user_id: str, data: Dict[str, Any], folder: str = "data/users
                 pass
 
 
+def get_cached_user_data(user_id: str, folder: str = "data/users") -> Optional[Dict[str, Any]]:
+    """Копия данных из кэша без обращения к диску; None, если пользователя в кэше нет."""
+    _sweep_cache()
+    key = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+        if cached is None:
+            return None
+        _CACHE_TOUCHED[key] = time.monotonic()
+        return copy.deepcopy(cached)
+
+
+def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+    """
+    Читаем из кэша, при промахе — с диска (и запоминаем).
+    Возвращаем копию: вызывающий код свободно мутирует её до save_user_data.
+    """
+    cached = get_cached_user_data(user_id, folder)
+    if cached is not None:
+        return cached
+
+    data = _read_user_file(user_id, folder)
+    key = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        # пока читали с диска, кто-то мог уже положить более свежую версию
+        data = _CACHE.setdefault(key, data)
+        _CACHE_TOUCHED[key] = time.monotonic()
+        return copy.deepcopy(data)
+
+
+def cache_user_data(user_id: str, data: Dict[str, Any], folder: str = "data/users") -> None:
+    """Обновляет только кэш (нормализуя структуру); на диск — через flush_user_data."""
+    normalized = copy.deepcopy(_ensure_structure(data))
+    key = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        current = _CACHE.get(key)
+        if current is not None:
+            # состояние сценария меняется только через cache_user_field:
+            # анкета, загруженная обработчиком раньше, не должна его откатить
+            normalized["state"] = current.get("state")
+        _CACHE[key] = normalized
+        _mark_changed(key)
+
+
+def cache_user_field(
+    user_id: str, key: str, value: Any, folder: str = "data/users", load: bool = True
+) -> bool:
+    """
+    Меняет одно поле верхнего уровня только в кэше, без копирования всей анкеты.
+    На диск — через flush_user_data.
+    load=False: если анкеты в кэше нет, не читаем диск и возвращаем False.
+    """
+    ck = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = ck in _CACHE
+    if not cached:
+        if not load:
+            return False
+        # подтягиваем анкету с диска в кэш
+        load_user_data(user_id, folder)
+    with _CACHE_LOCK:
+        _CACHE[ck][key] = copy.deepcopy(value)
+        _mark_changed(ck)
+    return True
+
+
+def cache_model_reply(
+    user_id: str,
+    history_entry: Tuple[str, str],
+    reply: str,
+    last_program: Optional[str] = None,
+    folder: str = "data/users",
+) -> None:
+    """
+    Дописывает ответ модели в анкету в кэше: запись истории, last_reply и,
+    для программ, last_program. Остальные поля не трогаем — пока шла генерация,
+    пользователь мог поменять анкету, и старая копия не должна это откатить.
+    На диск — через flush_user_data.
+    """
+    ck = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = ck in _CACHE
+    if not cached:
+        # подтягиваем анкету с диска в кэш
+        load_user_data(user_id, folder)
+    with _CACHE_LOCK:
+        d = _CACHE[ck]
+        hist = d.get("history") or []
+        hist.append(history_entry)
+        d["history"] = hist[-HISTORY_LIMIT:]
+        d["last_reply"] = reply
+        if last_program is not None:
+            d["last_program"] = last_program
+        _mark_changed(ck)
+
+
+def flush_user_data(user_id: str, folder: str = "data/users") -> None:
+    """
+    Пишет на диск актуальное содержимое кэша. Берём снимок в момент записи,
+    поэтому даже «опоздавший» flush не затрёт файл устаревшей версией.
+    """
+    key = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        file_lock = _FILE_LOCKS.setdefault(key, threading.Lock())
+    with file_lock:
+        with _CACHE_LOCK:
+            cached = _CACHE.get(key)
+            snapshot = None if cached is None else copy.deepcopy(cached)
+            version = _CACHE_VERSION.get(key, 0)
+        if snapshot is not None:
+            _write_user_file(user_id, snapshot, folder)
+            with _CACHE_LOCK:
+                _FLUSHED_VERSION[key] = max(version, _FLUSHED_VERSION.get(key, 0))
+
+
+def save_user_data(user_id: str, data: Dict[str, Any], folder: str = "data/users") -> None:
+    """
+    Синхронная запись: обновляем кэш и сразу пишем файл.
+    Параллельно нормализуем структуру.
+    """
+    cache_user_data(user_id, data, folder)
+    flush_user_data(user_id, folder)
+
 
 def get_user_name(user_id: str, folder: str = "data/users") -> Optional[str]:
     d = load_user_data(user_id, folder)
@@ -195,6 +388,19 @@ def get_last_reply(user_id: str, folder: str = "data/users") -> Optional[str]:
     return d.get("last_reply")
 
 
+def get_cached_user_state(user_id: str, folder: str = "data/users") -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """
+    Состояние сценария из кэша без обращения к диску и без копии всей анкеты.
+    (False, None), если анкеты в кэше нет.
+    """
+    ck = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(ck)
+        if cached is None:
+            return False, None
+        return True, copy.deepcopy(cached.get("state"))
+
+
 def set_last_program(user_id: str, text: Optional[str], folder: str = "data/users") -> Optional[str]:
     """
     Храним последнюю сгенерированную ПРОГРАММУ отдельно от last_reply,
@@ -211,12 +417,88 @@ def get_last_program(user_id: str, folder: str = "data/users") -> Optional[str]:
     return d.get("last_program")
 
 
-def set_user_goal(user_id: str, goal: str, folder: str = "data/users") -> Dict[str, Any]:
+def apply_saved_program(
+    d: Dict[str, Any], ts: int, filename: str, file_id: Optional[str] = None
+) -> Dict[str, Any]:
     """
-    Устанавливает новую цель тренировок для пользователя.
-    Добавляет запись в историю об изменении цели.
+    Добавляет файл в индекс сохранённых программ уже загруженной анкеты (без записи на диск).
+    file_id — id документа в Telegram: по нему файл можно отправить повторно без загрузки.
     """
+    saved = d.get("saved_programs") or []
+    entry: Dict[str, Any] = {"ts": int(ts), "filename": filename}
+    if file_id:
+        entry["file_id"] = file_id
+    saved.append(entry)
+    d["saved_programs"] = saved[-SAVED_PROGRAMS_LIMIT:]
+    return d
+
+
+def cache_legacy_saved_programs(
+    user_id: str, files: List[Tuple[int, str]], folder: str = "data/users"
+) -> bool:
+    """
+    Один раз переносит в индекс файлы, сохранённые до его появления (ts, filename),
+    и отмечает анкету просканированной. Только кэш; на диск — через flush_user_data.
+    Возвращает True, если анкета изменилась.
+    """
+    ck = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = ck in _CACHE
+    if not cached:
+        load_user_data(user_id, folder)
+    with _CACHE_LOCK:
+        d = _CACHE[ck]
+        if d.get("saved_programs_scanned"):
+            return False
+        saved = [e for e in (d.get("saved_programs") or []) if isinstance(e, dict) and e.get("filename")]
+        known = {e["filename"] for e in saved}
+        saved.extend({"ts": int(ts), "filename": name} for ts, name in files if name not in known)
+        saved.sort(key=lambda e: e.get("ts") or 0)
+        d["saved_programs"] = saved[-SAVED_PROGRAMS_LIMIT:]
+        d["saved_programs_scanned"] = True
+        _mark_changed(ck)
+    return True
+
+
+def cache_saved_program_file_id(
+    user_id: str, filename: str, file_id: Optional[str], folder: str = "data/users"
+) -> bool:
+    """
+    Обновляет file_id файла в индексе (после повторной загрузки документа).
+    Только кэш; на диск — через flush_user_data. True, если запись нашлась и изменилась.
+    """
+    ck = _cache_key(user_id, folder)
+    with _CACHE_LOCK:
+        cached = ck in _CACHE
+    if not cached:
+        load_user_data(user_id, folder)
+    with _CACHE_LOCK:
+        for entry in _CACHE[ck].get("saved_programs") or []:
+            if isinstance(entry, dict) and entry.get("filename") == filename:
+                if entry.get("file_id") == file_id:
+                    return False
+                if file_id:
+                    entry["file_id"] = file_id
+                else:
+                    entry.pop("file_id", None)
+                _mark_changed(ck)
+                return True
+    return False
+
+
+def get_saved_programs(user_id: str, folder: str = "data/users") -> List[Dict[str, Any]]:
+    """Индекс сохранённых программ, от новых к старым."""
     d = load_user_data(user_id, folder)
+    saved = [e for e in (d.get("saved_programs") or []) if isinstance(e, dict) and e.get("filename")]
+    saved.sort(key=lambda e: e.get("ts") or 0, reverse=True)
+    return saved
+
+
+def apply_user_goal(d: Dict[str, Any], goal: str) -> Dict[str, Any]:
+    """
+    Меняет цель тренировок в уже загруженной анкете (без записи на диск).
+    Добавляет запись в историю об изменении цели.
+    """
     old_goal = (d.get("physical_data") or {}).get("target")
     
     # обновляем цель
@@ -230,17 +512,21 @@ def set_user_goal(user_id: str, goal: str, folder: str = "data/users") -> Dict[s
             f"✅ Цель успешно изменена. Новая цель: {goal}"
         ))
         d["history"] = hist
-    
+    return d
+
+
+def set_user_goal(user_id: str, goal: str, folder: str = "data/users") -> Dict[str, Any]:
+    """Устанавливает новую цель тренировок для пользователя и сохраняет анкету."""
+    d = apply_user_goal(load_user_data(user_id, folder), goal)
     save_user_data(user_id, d, folder)
     return d
 
 
-def update_user_param(user_id: str, param_name: str, value: Any, folder: str = "data/users") -> Dict[str, Any]:
+def apply_user_param(d: Dict[str, Any], param_name: str, value: Any) -> Dict[str, Any]:
     """
-    Обновляет отдельный параметр в анкете пользователя.
+    Обновляет отдельный параметр в уже загруженной анкете (без записи на диск).
     param_name: 'weight', 'schedule', 'restrictions', 'level', 'age', 'height', 'goal'
     """
-    d = load_user_data(user_id, folder)
     old_value = (d.get("physical_data") or {}).get(param_name)
     
     # обновляем параметр
@@ -266,7 +552,12 @@ def update_user_param(user_id: str, param_name: str, value: Any, folder: str = "
             f"Новое значение: {value}" + (f" (было: {old_value})" if old_value else "")
         ))
         d["history"] = hist
-    
+    return d
+
+
+def update_user_param(user_id: str, param_name: str, value: Any, folder: str = "data/users") -> Dict[str, Any]:
+    """Обновляет отдельный параметр в анкете пользователя и сохраняет её."""
+    d = apply_user_param(load_user_data(user_id, folder), param_name, value)
     save_user_data(user_id, d, folder)
     return d
 
@@ -0,0 +1,154 @@
+"""
+Ограничение частоты исходящих запросов к Bot API.
+
+Подключается через ApplicationBuilder().rate_limiter(...), поэтому все вызовы
+send_message / reply_text / edit_text / send_document проходят через него
+без правок в обработчиках.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger("bot.sender")
+
+
+class _SlidingWindow:
+    """Не больше max_calls вызовов за period секунд."""
+
+    def __init__(self, max_calls: int, period: float):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls: Deque[float] = deque()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self._calls[0]))
+
+
+class _TokenBucket:
+    """Ведро токенов: до capacity запросов подряд, дальше — rate в секунду."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SendRateLimiter(BaseRateLimiter[int]):
+    """
+    Общий лимит бота (30 сообщений/сек), лимит на групповой чат (20 в минуту)
+    и ведро на личный чат: короткая пачка (ответ из нескольких частей) уходит
+    сразу, дальше — не чаще раза в секунду.
+    На RetryAfter ждём указанное Telegram время и повторяем запрос.
+    """
+
+    def __init__(
+        self,
+        overall_max_rate: int = 30,
+        group_max_rate: int = 20,
+        group_time_period: float = 60,
+        private_burst: int = 5,
+        private_rate: float = 1.0,
+        max_retries: int = 2,
+    ):
+        self._overall = _SlidingWindow(overall_max_rate, 1.0)
+        self._group_max_rate = group_max_rate
+        self._group_time_period = group_time_period
+        self._groups: Dict[Union[str, int], _SlidingWindow] = {}
+        self._private_burst = private_burst
+        self._private_rate = private_rate
+        self._private: Dict[int, _TokenBucket] = {}
+        self._max_retries = max_retries
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _group_window(self, chat_id: Union[str, int]) -> _SlidingWindow:
+        window = self._groups.get(chat_id)
+        if window is None:
+            window = _SlidingWindow(self._group_max_rate, self._group_time_period)
+            self._groups[chat_id] = window
+        return window
+
+    def _private_bucket(self, chat_id: int) -> _TokenBucket:
+        bucket = self._private.get(chat_id)
+        if bucket is None:
+            if len(self._private) >= 10_000:
+                # вёдра, успевшие наполниться, ничего не ограничивают — выбрасываем
+                now = time.monotonic()
+                self._private = {cid: b for cid, b in self._private.items() if not b.is_full(now)}
+            bucket = _TokenBucket(self._private_burst, self._private_rate)
+            self._private[chat_id] = bucket
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        max_retries = self._max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        # групповые чаты/каналы: отрицательный id или @username
+        is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+
+        for attempt in range(max_retries + 1):
+            if is_group:
+                await self._group_window(chat_id).acquire()
+            elif chat_id is not None:
+                await self._private_bucket(chat_id).acquire()
+            await self._overall.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                delay = e.retry_after
+                if not isinstance(delay, (int, float)):
+                    delay = delay.total_seconds()
+                logger.warning("Rate limit hit on %s, retry in %s s", endpoint, delay)
+                await asyncio.sleep(delay + 0.1)
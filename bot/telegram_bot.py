@@ -1,31 +1,181 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import re
 import time
 import logging
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional, Dict, List
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional, Dict, List, Set, Tuple, TypeVar
 
 from telegram import Update, ReplyKeyboardMarkup, Chat
-from telegram.constants import ParseMode
+from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import ContextTypes
 
-from app.agent import FitnessAgent
 from app.storage import (
-    load_user_data, save_user_data, set_last_reply, get_last_reply, 
-    set_user_goal, update_user_param, get_user_profile_text,
+    cache_legacy_saved_programs, cache_saved_program_file_id, get_saved_programs,
+    get_cached_user_state, get_user_profile_text,
     validate_age, validate_height, validate_weight, validate_schedule
 )
+from bot.user_cache import (
+    add_cached_saved_program, load_cached, mark_dirty, save_cached, save_last_reply, save_state,
+    set_cached_goal, update_cached_param,
+)
+
+if TYPE_CHECKING:
+    # app.agent тянет за собой клиент GigaChat — импортируем его только при первом обращении к модели
+    from app.agent import FitnessAgent
 
 logger = logging.getLogger("bot.telegram_bot")
 
-LAST_REPLIES: dict[str, str] = {}
 
-user_states: Dict[str, dict] = {}
+class _LRU(OrderedDict):
+    """
+    Словарь с ограничением размера: при переполнении выкидываем запись,
+    к которой дольше всего не обращались (чтение тоже продлевает жизнь).
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+STATE_TTL = 24 * 3600  # секунд: брошенный на полпути сценарий после этого сбрасываем
+
+
+class UserState:
+    """Состояние сценария пользователя: режим, шаг опроса и накопленные ответы."""
+
+    __slots__ = ("mode", "step", "data", "updated")
+
+    def __init__(
+        self,
+        mode: Optional[str] = None,
+        step: int = 0,
+        data: Optional[dict] = None,
+        updated: Optional[float] = None,
+    ):
+        self.mode = mode
+        self.step = step
+        self.data = {} if data is None else data
+        # время по часам системы: состояние хранится в анкете и переживает перезапуск
+        self.updated = time.time() if updated is None else updated
+
+    def is_stale(self, now: float) -> bool:
+        return now - self.updated > STATE_TTL
+
+    def to_dict(self) -> dict:
+        return {"mode": self.mode, "step": self.step, "data": self.data, "updated": self.updated}
+
+    @classmethod
+    def from_dict(cls, raw: Optional[dict]) -> Optional["UserState"]:
+        if not raw:
+            return None
+        return cls(raw.get("mode"), raw.get("step") or 0, raw.get("data") or {}, raw.get("updated"))
+
+
+class _PersistentStates(_LRU):
+    """
+    Состояния сценариев с записью в анкету: незавершённый опрос переживает
+    перезапуск бота. В памяти — LRU поверх кэша анкет; None означает «нет сценария».
+    Сценарий, к которому не возвращались примерно STATE_TTL, считается брошенным.
+    """
+
+    async def load(self, key) -> None:
+        """После перезапуска/вытеснения подтягивает состояние из анкеты (с диска — в потоке)."""
+        if key not in self:
+            data = await load_cached(str(key))
+            if key not in self:
+                super().__setitem__(key, UserState.from_dict(data.get("state")))
+
+    def get(self, key, default=None):
+        if key not in self:
+            # без load() диск на event loop не читаем: берём состояние, только если анкета уже в кэше
+            cached, raw = get_cached_user_state(str(key))
+            if not cached:
+                return default
+            super().__setitem__(key, UserState.from_dict(raw))
+        value = super().__getitem__(key)
+        if value is not None:
+            now = time.time()
+            if value.is_stale(now):
+                self[key] = value = None
+            elif now - value.updated > STATE_TTL / 2:
+                # сценарием пользуются — продлеваем; анкету переписываем не чаще раза в полсрока
+                value.updated = now
+                self[key] = value
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        save_state(str(key), None if value is None else value.to_dict())
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        if value is not None:
+            self[key] = None
+        return default if value is None else value
+
+
+# ключи runtime-словарей — int user_id из Telegram; в строку переводим только на границе storage/agent
+user_states: Dict[int, UserState] = _PersistentStates(maxsize=20_000)
+
+# состояние «вне сценария» — общий объект только для чтения; его НЕ мутируем,
+# при старте сценария в user_states кладётся новый UserState
+_DEFAULT_STATE = UserState()
+
+GIGACHAT_TOKEN = os.getenv("GIGACHAT_TOKEN")
+
+# Кэш агентов: user_id -> (время создания, FitnessAgent); не создаём агента на каждое сообщение.
+# Число агентов ограничено LRU, неактивные вытесняются первыми
+_AGENTS: Dict[int, Tuple[float, FitnessAgent]] = _LRU(maxsize=1000)
+AGENT_TTL = 3600  # секунд жизни закэшированного агента
+
+# Блокировки на пользователя: два быстрых сообщения не должны гонять state параллельно
+_USER_LOCKS: Dict[int, asyncio.Lock] = {}
+# когда блокировку брали последний раз; простаивающие дольше LOCK_IDLE_TTL удаляем
+_LOCK_LAST_USED: Dict[int, float] = {}
+LOCK_IDLE_TTL = 3600  # секунд
+LOCK_SWEEP_INTERVAL = 600  # как часто проверяем простаивающие блокировки
+_last_lock_sweep = 0.0
+
+# пользователи, у которых сейчас идёт фоновая генерация программы
+_BUSY_USERS: Set[int] = set()
+# держим ссылки на фоновые генерации, чтобы задачи не собрал GC до завершения
+_BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+# debounce свободного текста: пользователь часто дробит мысль на 2–3 сообщения
+TEXT_DEBOUNCE = 0.3  # секунд ждём продолжения перед запросом к модели
+_DEBOUNCE_BUFFERS: Dict[int, List[str]] = {}
+_DEBOUNCE_FLUSHERS: Dict[int, Callable[[str], Awaitable[None]]] = {}
+_DEBOUNCE_TIMERS: Dict[int, asyncio.TimerHandle] = {}
 
 # Rate limiting: user_id -> последнее время генерации
-last_generation_time: Dict[str, float] = {}
+last_generation_time: Dict[int, float] = _LRU(maxsize=50_000)
 GENERATION_COOLDOWN = 30  # секунд между генерациями
 
 GOAL_MAPPING = {
@@ -50,6 +200,11 @@ GENDER_KEYBOARD = ReplyKeyboardMarkup(
 )
 
 LEVEL_CHOICES = ["🚀 Начинающий", "🔥 Опытный"]
+# кнопка -> уровень в анкете; заодно проверка «нажата ли кнопка уровня»
+LEVEL_MAPPING = {
+    "🚀 Начинающий": "начинающий",
+    "🔥 Опытный": "опытный",
+}
 LEVEL_KEYBOARD = ReplyKeyboardMarkup(
     [LEVEL_CHOICES],
     resize_keyboard=True,
@@ -67,6 +222,7 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup(
     resize_keyboard=True,
     is_persistent=True,
 )
+MAIN_MENU_TEXT = "Что дальше? Выбери действие в меню ⬇️"
 
 VARIATIONS_KEYBOARD = ReplyKeyboardMarkup(
     [
@@ -79,6 +235,15 @@ VARIATIONS_KEYBOARD = ReplyKeyboardMarkup(
     one_time_keyboard=True,
 )
 
+# кнопка стиля -> пожелание к программе для модели
+VARIATION_PROMPTS = {
+    "💪 Больше базовых": "Сделай акцент на базовые многосуставные упражнения (приседания, становая, жимы, подтягивания и тому подобные базовые силовые упражнения для тренажерного зала).",
+    "🎯 Больше изоляции": "Добавь больше изолирующих упражнений для проработки отдельных мышечных групп.",
+    "🏋️ Акцент на силу": "Программа с акцентом на развитие силы: меньше повторений (4-6), больше отдыха, тяжелые веса.",
+    "⚡ Акцент на выносливость": "Программа с акцентом на выносливость: больше повторений (15-20), меньше отдыха, умеренные веса.",
+    "🎲 Случайная вариация": "Сделай максимально разнообразную и нестандартную программу, используй креативные упражнения.",
+}
+
 MUSCLE_GROUPS_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["🦵 Упор на ноги", "🍑 Упор на ягодицы"],
@@ -90,6 +255,58 @@ MUSCLE_GROUPS_KEYBOARD = ReplyKeyboardMarkup(
     one_time_keyboard=True,
 )
 
+# последовательность вопросов анкеты (возраст → ... → частота)
+SURVEY_QUESTIONS: Tuple[Tuple[str, str], ...] = (
+    ("age", "Сколько тебе лет?"),
+    ("height", "Твой рост в сантиметрах?"),
+    ("weight", "Твой текущий вес в килограммах?"),
+    ("goal", "Желаемый вес в килограммах?"),
+    ("restrictions", "Есть ли ограничения по здоровью или предпочтения в тренировках?"),
+    ("schedule", "Сколько раз в неделю можешь посещать тренажёрный зал?"),
+)
+SURVEY_LEN = len(SURVEY_QUESTIONS)
+# ключи и тексты вопросов отдельно — в обработчике не распаковываем пары
+SURVEY_KEYS: Tuple[str, ...] = tuple(key for key, _ in SURVEY_QUESTIONS)
+SURVEY_TEXTS: Tuple[str, ...] = tuple(text for _, text in SURVEY_QUESTIONS)
+
+def _validate_restrictions(text: str) -> Tuple[bool, Optional[str], str]:
+    # для ограничений валидация не нужна, принимаем любой текст
+    return True, (text if text.lower() not in ("нет", "no", "-") else None), ""
+
+# поле анкеты -> валидатор (valid, value, error); общий для опроса и редактирования
+FIELD_VALIDATORS: Dict[str, Callable[[str], Tuple[bool, object, str]]] = {
+    "age": validate_age,
+    "height": validate_height,
+    "weight": validate_weight,
+    "goal": validate_weight,
+    "restrictions": _validate_restrictions,
+    "schedule": validate_schedule,
+}
+
+# режим редактирования -> (поле анкеты, текст подтверждения)
+EDIT_FIELDS: Dict[str, Tuple[str, str]] = {
+    "editing_age": ("age", "✅ Возраст успешно обновлён: {value} лет"),
+    "editing_weight": ("weight", "✅ Текущий вес успешно обновлён: {value} кг"),
+    "editing_goal_weight": ("goal", "✅ Желаемый вес успешно обновлён: {value} кг"),
+    "editing_schedule": ("schedule", "✅ Частота тренировок успешно обновлена: {value} раз/неделю"),
+    "editing_restrictions": ("restrictions", "✅ Ограничения / предпочтения успешно обновлены: {value}"),
+}
+
+# кнопка -> значение preferred_muscle_group в анкете
+MUSCLE_GROUP_MAPPING = {
+    "🦵 Упор на ноги": "ноги",
+    "🍑 Упор на ягодицы": "ягодицы",
+    "🔙 Упор на спину": "спина",
+    "💪 Упор на плечи и руки": "плечи и руки",
+    "🎲 Сбалансированная программа": "сбалансированно",
+}
+
+# кнопка -> акцент для разовой программы (формулировка уходит прямо в промпт)
+PROGRAM_MUSCLE_GROUPS = {
+    **MUSCLE_GROUP_MAPPING,
+    "🎲 Сбалансированная программа": "все группы мышц сбалансированно",
+}
+
 EDIT_PARAMS_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["👤 Имя", "🔢 Возраст"],
@@ -104,16 +321,37 @@ EDIT_PARAMS_KEYBOARD = ReplyKeyboardMarkup(
 )
 
 
+# регулярки для _sanitize_for_tg компилируем один раз
+_RE_HEADER = re.compile(r"^\s*#{1,6}\s*", re.MULTILINE)
+_RE_BR = re.compile(r"\s*<br\s*/?>\s*", re.IGNORECASE)
+_RE_P = re.compile(r"</?p\s*/?>", re.IGNORECASE)
+_RE_BLANKS = re.compile(r"\n{3,}")
+# символы разметки Telegram Markdown; без них parse_mode не нужен
+_RE_MD_CHARS = re.compile(r"[*_`\[]")
+# одиночное «_» внутри слова (snake_case, ссылки) ломает Markdown-парсер
+_RE_WORD_UNDERSCORE = re.compile(r"(?<=\w)_(?=\w)")
+
+# общие параметры send_message: не собираем одни и те же kwargs на каждый кусок
+_SEND_MD = {"parse_mode": ParseMode.MARKDOWN, "disable_web_page_preview": True}
+_SEND_PLAIN = {"disable_web_page_preview": True}
+
 def _sanitize_for_tg(text: str) -> str:
     """Убираем лишние HTML/markdown артефакты и заголовочные #."""
-    out = text or ""
+    if not text:
+        return ""
+    out = text
+    # каждую замену запускаем, только если в тексте есть её «триггерный» символ:
+    # проверка через `in` намного дешевле лишнего прохода регуляркой
     # убрать #/## из начала строк
-    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
+    if "#" in out:
+        out = _RE_HEADER.sub("", out)
     # <br>, <p>
-    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
-    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
+    if "<" in out:
+        out = _RE_BR.sub("\n", out)
+        out = _RE_P.sub("\n", out)
     # убрать лишние пустые строки (>2 подряд -> 2)
-    out = re.sub(r"\n{3,}", "\n\n", out)
+    if "\n\n\n" in out:
+        out = _RE_BLANKS.sub("\n\n", out)
     return out.strip()
 
 def _split_for_telegram(text: str, max_len: int = 3500) -> List[str]:
@@ -121,49 +359,150 @@ def _split_for_telegram(text: str, max_len: int = 3500) -> List[str]:
     if len(text) <= max_len:
         return [text]
 
+    # идём по исходной строке индексом, не копируя «остаток» на каждой итерации
     parts: List[str] = []
-    remaining = text
-    while len(remaining) > max_len:
+    n = len(text)
+    start = 0
+    while n - start > max_len:
+        end = start + max_len
         # пробуем найти границу дня
-        cut = remaining.rfind("\n\nДень ", 0, max_len)
-        if cut < 0:
-            cut = remaining.rfind("\n\n**День", 0, max_len)
-        if cut < 0:
-            cut = remaining.rfind("\n\n", 0, max_len)
-        if cut < 0:
-            cut = max_len
-        parts.append(remaining[:cut].strip())
-        remaining = remaining[cut:].strip()
-    if remaining:
-        parts.append(remaining)
+        cut = text.rfind("\n\nДень ", start, end)
+        if cut <= start:
+            cut = text.rfind("\n\n**День", start, end)
+        if cut <= start:
+            cut = text.rfind("\n\n", start, end)
+        if cut <= start:
+            cut = end
+        parts.append(text[start:cut].strip())
+        # пропускаем пробелы на границе куска
+        start = cut
+        while start < n and text[start].isspace():
+            start += 1
+    tail = text[start:].rstrip()
+    if tail:
+        parts.append(tail)
     return parts
 
+def _escape_md(chunk: str) -> str:
+    """Экранируем «_» внутри слов, чтобы Markdown не падал на непарной разметке."""
+    if "`" in chunk:
+        # внутри code-блоков экранирование видно буквально — не трогаем
+        return chunk
+    return _RE_WORD_UNDERSCORE.sub(r"\\_", chunk)
+
+def _markdown_balanced(chunk: str) -> bool:
+    """Грубая проверка: у каждого маркера Markdown (*, _, `) есть пара."""
+    underscores = chunk.count("_") - chunk.count("\\_")
+    return chunk.count("*") % 2 == 0 and chunk.count("`") % 2 == 0 and underscores % 2 == 0
+
+async def _send_one(chat: Chat, chunk: str, use_markdown: bool):
+    """Отправка одного куска: Markdown, если есть разметка, с fallback в обычный текст."""
+    # без символов разметки шлём как обычный текст — нечего парсить и не на чем падать
+    if not use_markdown or not _RE_MD_CHARS.search(chunk):
+        await chat.send_message(chunk, **_SEND_PLAIN)
+        return
+    escaped = _escape_md(chunk)
+    # непарную разметку Telegram всё равно отклонит — не тратим на это запрос
+    if not _markdown_balanced(escaped):
+        await chat.send_message(chunk, **_SEND_PLAIN)
+        return
+    try:
+        await chat.send_message(escaped, **_SEND_MD)
+    except Exception as e:
+        logger.error("Markdown failed, fallback to plain. Err: %s", e)
+        await chat.send_message(chunk, **_SEND_PLAIN)
+
 async def _safe_send(chat: Chat, text: str, use_markdown: bool = True):
-    """Безопасная отправка: разбивка на куски + fallback без Markdown при ошибке."""
-    text = text.strip()
+    """
+    Безопасная отправка: разбивка на куски + fallback без Markdown при ошибке.
+    text — результат _sanitize_for_tg, пробелы по краям он уже срезал.
+    """
+    # куски шлём строго по очереди: параллельные запросы Telegram может доставить
+    # не по порядку, и «День 3» окажется перед «День 1»
     for chunk in _split_for_telegram(text):
+        await _send_one(chat, chunk, use_markdown)
+
+TYPING_INTERVAL = 4.0  # секунд; Telegram сам гасит «печатает…» примерно через 5 с
+
+_T = TypeVar("_T")
+
+async def _keep_typing(chat: Chat, stop: asyncio.Event):
+    """Повторяем «печатает…», пока не выставят stop."""
+    while not stop.is_set():
         try:
-            if use_markdown:
-                await chat.send_message(
-                    chunk,
-                    parse_mode=ParseMode.MARKDOWN,
-                    disable_web_page_preview=True,
-                )
-            else:
-                await chat.send_message(chunk, disable_web_page_preview=True)
+            await chat.send_chat_action(ChatAction.TYPING)
         except Exception as e:
-            logger.error("Markdown failed, fallback to plain. Err: %s", e)
-            await chat.send_message(chunk, disable_web_page_preview=True)
+            # индикатор — только косметика, из-за него генерацию не роняем
+            logger.debug("send_chat_action failed: %s", e)
+        try:
+            await asyncio.wait_for(stop.wait(), TYPING_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def _with_typing(chat: Chat, aw: Awaitable[_T]) -> _T:
+    """Ждём ответ модели, показывая в чате индикатор набора."""
+    stop = asyncio.Event()
+    typing = asyncio.create_task(_keep_typing(chat, stop))
+    try:
+        return await aw
+    finally:
+        stop.set()
+        await typing
+
+# тексты ошибок генерации для разных сценариев: ключ из _classify_error -> сообщение
+PROGRAM_ERROR_MSGS: Dict[str, str] = {
+    "timeout": "⏱️ Сервер не ответил вовремя. Попробуй ещё раз через минуту.",
+    "connection": "🌐 Проблемы с подключением к серверу. Попробуй позже.",
+    "auth": "🔒 Проблема с авторизацией. Свяжись с администратором.",
+    "other": "Попробуй ещё раз позже.\n\nТехническая информация: {details}",
+}
+ANSWER_ERROR_MSGS: Dict[str, str] = {
+    "timeout": "⏱️ Сервер не ответил вовремя. Попробуй переформулировать вопрос.",
+    "connection": "🌐 Проблемы с подключением. Попробуй позже.",
+    "other": "Попробуй задать вопрос ещё раз.",
+}
+FIRST_PROGRAM_ERROR_MSGS: Dict[str, str] = {
+    "timeout": "⏱️ Сервер не ответил вовремя. Используй кнопку «🆕 Другая программа» чтобы попробовать снова.",
+    "connection": "🌐 Проблемы с подключением. Попробуй через минуту кнопкой «🆕 Другая программа».",
+    "other": "Попробуй через кнопку «🆕 Другая программа» в главном меню.",
+}
+
+def _classify_error(e: Exception) -> str:
+    """Тип ошибки: "timeout" / "connection" / "auth" / "other"."""
+    msg = str(e)
+    low = msg.lower()
+    if "timeout" in low:
+        return "timeout"
+    if "connection" in low:
+        return "connection"
+    if "unauthorized" in low or "403" in msg:
+        return "auth"
+    return "other"
+
+def _error_text(e: Exception, header: str, messages: Dict[str, str]) -> str:
+    """Сообщение пользователю об ошибке генерации; неизвестные типы идут в "other"."""
+    template = messages.get(_classify_error(e), messages["other"])
+    return header + template.format(details=str(e)[:100])
 
 async def _send_main_menu(update: Update):
     await update.effective_chat.send_message(
-        "Что дальше? Выбери действие в меню ⬇️",
+        MAIN_MENU_TEXT,
         reply_markup=MAIN_KEYBOARD,
     )
 
-async def _save_last_to_file(update: Update, user_id: str):
+async def _deliver_reply(update: Update, user_id: int, reply: str, label: str, show_menu: bool = True):
+    """Общий хвост всех генераций: чистим ответ модели, запоминаем как последний и отправляем."""
+    reply = _sanitize_for_tg(reply)
+    save_last_reply(str(user_id), reply)
+    logger.info(f"{label} sent to user {user_id}, length: {len(reply)} chars")
+    await _safe_send(update.effective_chat, reply, use_markdown=True)
+    if show_menu:
+        await _send_main_menu(update)
+
+async def _save_last_to_file(update: Update, user_id: int):
     """Сохранение последней программы/ответа в файл .txt и отправка документом."""
-    text = LAST_REPLIES.get(user_id) or get_last_reply(user_id) or ""
+    # последний ответ хранится в анкете (она и так в кэше) — отдельная копия в памяти не нужна
+    text = (await load_cached(str(user_id))).get("last_reply") or ""
     if not text.strip():
         await update.effective_chat.send_message(
             "Сначала сгенерируй программу (кнопкой «📄 Другая программа»)."
@@ -171,20 +510,87 @@ async def _save_last_to_file(update: Update, user_id: str):
         return
     ts = int(time.time())
     fname = f"program_{user_id}_{ts}.txt"
+    payload = text.encode("utf-8")
+    # сначала файл: если запись не удалась, пользователь не получит документ, которого нет в истории
+    await asyncio.to_thread(_write_saved_program, fname, payload)
+    message = None
+    try:
+        # текст уже в памяти — отдаём байты напрямую, не перечитывая файл
+        message = await update.effective_chat.send_document(
+            payload, filename=fname, caption="Вот файл с твоим последним запросом 👌🏼"
+        )
+    finally:
+        # файл на диске попадает в индекс, даже если отправка упала; file_id —
+        # чтобы «📑 История ответов» отправила документ повторно без загрузки
+        file_id = message.document.file_id if message and message.document else None
+        # индекс — в кэш анкеты, на диск уйдёт общей отложенной записью
+        await add_cached_saved_program(str(user_id), ts, fname, file_id)
+
+def _write_saved_program(fname: str, payload: bytes) -> None:
+    """Блокирующая часть сохранения: файл пишем через *.tmp → os.replace, чтобы не оставить обрезанный."""
     out_path = Path("data/users") / fname
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(text, encoding="utf-8")
-    with open(out_path, "rb") as fh:
-        await update.effective_chat.send_document(
-            fh, filename=fname, caption="Вот файл с твоим последним запросом 👌🏼"
-        )
+    tmp_path = out_path.with_suffix(".txt.tmp")
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, out_path)
+
+def _scan_legacy_programs(user_id: int) -> List[Tuple[int, str]]:
+    """Файлы, сохранённые до появления индекса: (ts, имя файла). Блокирующая часть — glob + stat."""
+    found = []
+    for f in Path("data/users").glob(f"program_{user_id}_*.txt"):
+        try:
+            ts = int(f.stem.split('_')[-1])
+        except ValueError:
+            ts = int(f.stat().st_mtime)
+        found.append((ts, f.name))
+    return found
+
+async def _list_saved_programs(user_id: int) -> List[Tuple[Path, Optional[str]]]:
+    """Файлы сохранённых программ пользователя (путь, file_id в Telegram), от новых к старым."""
+    uid = str(user_id)
+    if not (await load_cached(uid)).get("saved_programs_scanned"):
+        # каталог сканируем один раз: старые файлы попадают в индекс рядом с новыми
+        legacy = await asyncio.to_thread(_scan_legacy_programs, user_id)
+        if await asyncio.to_thread(cache_legacy_saved_programs, uid, legacy):
+            mark_dirty(uid)
+    user_dir = Path("data/users")
+    saved = await asyncio.to_thread(get_saved_programs, uid)
+    return [(user_dir / e["filename"], e.get("file_id")) for e in saved]
 
-async def _show_saved_programs(update: Update, user_id: str):
+def _saved_program_caption(file_path: Path) -> str:
+    try:
+        timestamp = int(file_path.stem.split('_')[-1])
+        tm = time.localtime(timestamp)
+        date_str = f"{tm.tm_mday:02d}.{tm.tm_mon:02d}.{tm.tm_year} {tm.tm_hour:02d}:{tm.tm_min:02d}"
+        return f"📎 Запрос от {date_str}"
+    except (ValueError, IndexError):
+        return f"📎 {file_path.name}"
+
+async def _send_saved_program(update: Update, user_id: int, file_path: Path, file_id: Optional[str] = None):
+    caption = _saved_program_caption(file_path)
+    if file_id:
+        # документ уже лежит на серверах Telegram — шлём по id, без чтения файла и загрузки
+        try:
+            await update.effective_chat.send_document(file_id, caption=caption)
+            return
+        except BadRequest as e:
+            logger.warning("Saved file_id rejected, re-uploading %s: %s", file_path.name, e)
+    try:
+        content = await asyncio.to_thread(file_path.read_bytes)
+    except OSError:
+        # файл из индекса могли удалить вручную — просто пропускаем
+        return
+    message = await update.effective_chat.send_document(content, filename=file_path.name, caption=caption)
+    # запоминаем свежий file_id, чтобы в следующий раз не упираться в отвергнутый и не грузить файл заново
+    new_id = message.document.file_id if message and message.document else None
+    if new_id != file_id and await asyncio.to_thread(
+        cache_saved_program_file_id, str(user_id), file_path.name, new_id
+    ):
+        mark_dirty(str(user_id))
+
+async def _show_saved_programs(update: Update, user_id: int):
     """Показывает список последних сохраненных программ пользователя."""
-    user_dir = Path("data/users")
-    pattern = f"program_{user_id}_*.txt"
-    
-    files = list(user_dir.glob(pattern))
+    files = await _list_saved_programs(user_id)
     
     if not files:
         await update.effective_chat.send_message(
@@ -192,198 +598,359 @@ async def _show_saved_programs(update: Update, user_id: str):
         )
         return
     
-    files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-    
     recent_files = files[:10]
     
     await update.effective_chat.send_message(
         f"📑 Найдено сохранённых ответов: {len(files)}\n\nОтправляю последние {len(recent_files)}..."
     )
     
-    for file_path in recent_files:
+    # по порядку, от новых к старым; сбой одного файла не обрывает отправку остальных
+    for fp, fid in recent_files:
         try:
-            timestamp = int(file_path.stem.split('_')[-1])
-            date_str = time.strftime("%d.%m.%Y %H:%M", time.localtime(timestamp))
-            caption = f"📎 Запрос от {date_str}"
-        except (ValueError, IndexError):
-            caption = f"📎 {file_path.name}"
-        
-        with open(file_path, "rb") as fh:
-            await update.effective_chat.send_document(
-                fh, filename=file_path.name, caption=caption
-            )
+            await _send_saved_program(update, user_id, fp, fid)
+        except TelegramError as e:
+            logger.warning("Failed to send saved program %s: %s", fp.name, e)
+
+def _get_agent(user_id: int) -> FitnessAgent:
+    """Возвращает агента пользователя из кэша; устаревший (старше AGENT_TTL) пересоздаём."""
+    now = time.monotonic()
+    cached = _AGENTS.get(user_id)
+    if cached is not None and now - cached[0] < AGENT_TTL:
+        return cached[1]
+    from app.agent import FitnessAgent
+    agent = FitnessAgent(token=GIGACHAT_TOKEN, user_id=str(user_id), on_saved=mark_dirty)
+    _AGENTS[user_id] = (now, agent)
+    return agent
+
+def lock_for(user_id: int) -> asyncio.Lock:
+    """Блокировка пользователя: под ней идут все его обновления (сообщения и /start)."""
+    now = time.monotonic()
+    _sweep_idle_locks(now)
+    lock = _USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = _USER_LOCKS[user_id] = asyncio.Lock()
+    _LOCK_LAST_USED[user_id] = now
+    return lock
+
+def _sweep_idle_locks(now: float) -> None:
+    """Раз в LOCK_SWEEP_INTERVAL выкидываем свободные блокировки давно неактивных пользователей."""
+    global _last_lock_sweep
+    if now - _last_lock_sweep < LOCK_SWEEP_INTERVAL:
+        return
+    _last_lock_sweep = now
+    for uid, last_used in list(_LOCK_LAST_USED.items()):
+        if now - last_used > LOCK_IDLE_TTL and not _USER_LOCKS[uid].locked():
+            del _USER_LOCKS[uid]
+            del _LOCK_LAST_USED[uid]
+
+def _spawn(coro: Awaitable[None]) -> None:
+    """Запускает корутину в фоне, не дожидаясь её; ошибки только логируем."""
+    task = asyncio.ensure_future(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_done)
+
+def _on_background_done(task: asyncio.Task) -> None:
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed: %s", task.exception())
+
+async def _reject_if_busy(update: Update, user_id: int) -> bool:
+    """Не даём запустить вторую генерацию, пока не закончилась первая."""
+    if user_id not in _BUSY_USERS:
+        return False
+    await update.message.reply_text("⏳ Предыдущий запрос ещё генерируется, подожди немного.")
+    return True
+
+def _debounce_text(user_id: int, text: str, flush: Callable[[str], Awaitable[None]]) -> None:
+    """
+    Копим сообщения, идущие подряд; если за TEXT_DEBOUNCE новых не пришло —
+    склеиваем их и отдаём в flush одной строкой (в фоне).
+    """
+    _DEBOUNCE_BUFFERS.setdefault(user_id, []).append(text)
+    _DEBOUNCE_FLUSHERS[user_id] = flush
+    timer = _DEBOUNCE_TIMERS.pop(user_id, None)
+    if timer is not None:
+        timer.cancel()
+    _DEBOUNCE_TIMERS[user_id] = asyncio.get_running_loop().call_later(
+        TEXT_DEBOUNCE, _flush_debounced, user_id
+    )
+
+def _flush_debounced(user_id: int) -> None:
+    timer = _DEBOUNCE_TIMERS.pop(user_id, None)
+    if timer is not None:
+        timer.cancel()
+    parts = _DEBOUNCE_BUFFERS.pop(user_id, None)
+    flush = _DEBOUNCE_FLUSHERS.pop(user_id, None)
+    if parts and flush is not None:
+        _spawn(flush("\n".join(parts)))
 
 def _normalize_name(raw: str) -> str:
     name = (raw or "").strip()
     return name[:80] if len(name) > 80 else name
 
+# ручной ввод пола: одна регулярка без lower(); группа 1 — женский, группа 2 — мужской
+_GENDER_RE = re.compile(r"(жен|👩)|(муж|👨)", re.IGNORECASE)
+
 def _normalize_gender(text: str) -> Optional[str]:
-    t = (text or "").lower()
-    if "жен" in t or "👩" in t:
+    t = (text or "").strip()
+    if not t:
+        return None
+    # быстрый путь: кнопка начинается с эмодзи — без регулярки вообще
+    c0 = t[0]
+    if c0 == "👩":
         return "женский"
-    if "муж" in t or "👨" in t:
+    if c0 == "👨":
         return "мужской"
-    return None
+    m = _GENDER_RE.search(t)
+    if m is None:
+        return None
+    return "женский" if m.group(1) else "мужской"
+
+async def _ask_registration(update: Update, user_id: int, name: Optional[str]):
+    """Анкета не заполнена: начинаем с имени или, если оно уже есть, с цели."""
+    if not name:
+        user_states[user_id] = UserState("awaiting_name")
+        await update.message.reply_text("Как тебя зовут?")
+        return
+    # если имя уже есть, добавляем его в state.data
+    user_states[user_id] = UserState("awaiting_goal", data={"name": name})
+    await update.message.reply_text(
+        f"{name}, выбери свою цель тренировок ⬇️",
+        reply_markup=GOAL_KEYBOARD,
+    )
 
-def _parse_goal(text: str) -> Optional[str]:
-    """Пытаемся распознать цель из кнопки/текста."""
-    t = (text or "").lower()
-    if any(w in t for w in ("похуд", "сброс", "жир")):
-        return "похудение"
-    if any(w in t for w in ("набра", "мас", "мышц")):
-        return "набор массы"
-    if any(w in t for w in ("поддерж", "форма", "тони", "укреп")):
-        return "поддержание формы"
-    return None
+async def _reply_profile_required(update: Update):
+    await update.message.reply_text(
+        "Сначала нужно заполнить анкету. Используй кнопку «🔁 Начать заново» для заполнения.",
+        reply_markup=MAIN_KEYBOARD,
+    )
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message:
-        return
+# ---- кнопки, которым не нужна анкета: (update, context, user_id) ----
+# обрабатываются до чтения файла пользователя
 
-    user_id = str(update.effective_user.id)
-    text = (update.message.text or "").strip()
+async def _handle_save_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    logger.info(f"User {user_id} saving last reply to file")
+    await _save_last_to_file(update, user_id)
 
-    # текущие данные пользователя
-    data = load_user_data(user_id)
-    phys = data.get("physical_data") or {}
-    name = phys.get("name")
-    completed = bool(data.get("physical_data_completed"))
-    state = user_states.get(user_id) or {"mode": None, "step": 0, "data": {}}
-    
-    logger.debug(f"handle_message - user_id: {user_id}, text: {text[:50]}, state.mode: {state.get('mode')}, completed: {completed}")
+async def _handle_history_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    logger.info(f"User {user_id} viewing saved programs history")
+    await _show_saved_programs(update, user_id)
 
+async def _handle_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    user_states.pop(user_id, None)
+    await update.message.reply_text("Главное меню ⬇️", reply_markup=MAIN_KEYBOARD)
 
-    if text == "💾 Сохранить в файл":
-        logger.info(f"User {user_id} ({name}) saving last reply to file")
-        await _save_last_to_file(update, user_id)
-        return
+async def _handle_other_program_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    # показываем меню выбора группы мышц
+    await update.message.reply_text(
+        "Выбери акцент программы на группу мышц ⬇️",
+        reply_markup=MUSCLE_GROUPS_KEYBOARD
+    )
 
-    if text == "📑 История ответов":
-        logger.info(f"User {user_id} ({name}) viewing saved programs history")
-        await _show_saved_programs(update, user_id)
-        return
 
-    if text == "📋 Моя анкета":
-        if not completed:
-            await update.message.reply_text(
-                "Сначала нужно заполнить анкету. Используй кнопку «🔁 Начать заново» для заполнения.",
-                reply_markup=MAIN_KEYBOARD,
-            )
-            return
-        logger.info(f"User {user_id} ({name}) viewing profile")
-        profile_text = get_user_profile_text(user_id)
-        await update.message.reply_text(profile_text, parse_mode=ParseMode.MARKDOWN)
-        return
+_STATELESS_HANDLERS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "💾 Сохранить в файл": _handle_save_button,
+    "📑 История ответов": _handle_history_button,
+    "◀️ Назад в меню": _handle_back_button,
+    "🆕 Другая программа": _handle_other_program_button,
+}
 
-    if text == "⚙️ Изменить параметры":
-        if not completed:
-            await update.message.reply_text(
-                "Сначала нужно заполнить анкету. Используй кнопку «🔁 Начать заново» для заполнения.",
-                reply_markup=MAIN_KEYBOARD,
-            )
-            return
-        logger.info(f"User {user_id} ({name}) opening edit parameters menu")
-        await update.message.reply_text(
-            "Выбери параметр для изменения ⬇️",
-            reply_markup=EDIT_PARAMS_KEYBOARD,
-        )
-        return
 
-    if text == "◀️ Назад в меню":
-        user_states.pop(user_id, None)
-        await update.message.reply_text("Главное меню ⬇️", reply_markup=MAIN_KEYBOARD)
-        return
+# ---- обработчики кнопок главного меню: (update, context, user_id, data, state) ----
 
-    if text == "🎯 Изменить цель":
-        # проверяем, заполнена ли анкета
-        if not completed:
-            await update.message.reply_text(
-                "Сначала нужно заполнить анкету. Используй кнопку «🔁 Начать заново» для заполнения.",
-                reply_markup=MAIN_KEYBOARD,
-            )
+def _requires_profile(handler: Callable[..., Awaitable[None]]) -> Callable[..., Awaitable[None]]:
+    """Обёртка для кнопок, которые имеют смысл только при заполненной анкете."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+        if not data.get("physical_data_completed"):
+            await _reply_profile_required(update)
             return
-            
-        logger.info(f"User {user_id} ({name}) changing goal from {phys.get('target')}")
-        
-        # переход в режим выбора новой цели
-        user_states[user_id] = {"mode": "changing_goal", "step": 0, "data": {}}
-        
-        # показываем текущую цель
-        current_goal = phys.get("target", "не указана")
-        await update.message.reply_text(
-            f"Текущая цель: {current_goal}\n\nВыбери новую цель тренировок ⬇️",
-            reply_markup=GOAL_KEYBOARD,
-        )
-        return
+        await handler(update, context, user_id, data, state)
+    return wrapper
+
+@_requires_profile
+async def _handle_profile_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    name = (data.get("physical_data") or {}).get("name")
+    logger.info(f"User {user_id} ({name}) viewing profile")
+    profile_text = await asyncio.to_thread(get_user_profile_text, str(user_id))
+    await update.message.reply_text(profile_text, parse_mode=ParseMode.MARKDOWN)
+
+@_requires_profile
+async def _handle_edit_params_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    name = (data.get("physical_data") or {}).get("name")
+    logger.info(f"User {user_id} ({name}) opening edit parameters menu")
+    await update.message.reply_text(
+        "Выбери параметр для изменения ⬇️",
+        reply_markup=EDIT_PARAMS_KEYBOARD,
+    )
 
-    if text == "🆕 Другая программа":
-        # показываем меню выбора группы мышц
-        await update.message.reply_text(
-            "Выбери акцент программы на группу мышц ⬇️",
-            reply_markup=MUSCLE_GROUPS_KEYBOARD
-        )
+@_requires_profile
+async def _handle_change_goal_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    phys = data.get("physical_data") or {}
+    logger.info(f"User {user_id} ({phys.get('name')}) changing goal from {phys.get('target')}")
+
+    # переход в режим выбора новой цели
+    user_states[user_id] = UserState("changing_goal")
+
+    # показываем текущую цель
+    current_goal = phys.get("target", "не указана")
+    await update.message.reply_text(
+        f"Текущая цель: {current_goal}\n\nВыбери новую цель тренировок ⬇️",
+        reply_markup=GOAL_KEYBOARD,
+    )
+
+async def _handle_restart_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    name = (data.get("physical_data") or {}).get("name")
+    logger.info(f"User {user_id} ({name}) restarting registration")
+
+    # полный сброс: имя, анкета, история, последняя программа/ответ
+    data["physical_data"] = {}                 # <- имя тоже очищаем
+    data["physical_data_completed"] = False
+    data["history"] = []
+    data["last_program"] = None
+    data["last_reply"] = None
+    save_cached(str(user_id), data)
+
+    # сбрасываем runtime-состояние и начинаем заново с вопроса про имя
+    user_states[user_id] = UserState("awaiting_name")
+    await update.message.reply_text("Заполним анкету заново 📝 Как тебя зовут?")
+
+async def _handle_qa_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    name = (data.get("physical_data") or {}).get("name")
+    if not data.get("physical_data_completed") and state.mode is None:
+        await _ask_registration(update, user_id, name)
         return
+    user_states[user_id] = UserState("qa")
+    await update.message.reply_text("Задай вопрос по тренировкам/питанию ✍🏼")
+    logger.info(f"User {user_id} ({name}) entered Q&A mode")
+
+
+# ---- кнопки меню «Изменить параметры» ----
+
+@_requires_profile
+async def _handle_edit_name_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_name")
+    current_name = data["physical_data"].get("name", "не указано")
+    await update.message.reply_text(
+        f"Текущее имя: {current_name}\n\nВведи новое имя:"
+    )
+
+@_requires_profile
+async def _handle_edit_age_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_age")
+    current_age = data["physical_data"].get("age", "не указан")
+    await update.message.reply_text(
+        f"Текущий возраст: {current_age} лет\n\nВведи новый возраст (10-100 лет):"
+    )
+
+@_requires_profile
+async def _handle_edit_weight_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_weight")
+    current_weight = data["physical_data"].get("weight", "не указан")
+    await update.message.reply_text(
+        f"Текущий вес: {current_weight} кг\n\nВведи новый текущий вес в килограммах (например: 75 или 75.5):"
+    )
+
+@_requires_profile
+async def _handle_edit_goal_weight_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_goal_weight")
+    current_goal = data["physical_data"].get("goal", "не указан")
+    await update.message.reply_text(
+        f"Желаемый вес: {current_goal} кг\n\nВведи новый желаемый вес в килограммах (например: 70 или 70.5):"
+    )
+
+@_requires_profile
+async def _handle_edit_schedule_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_schedule")
+    current_schedule = data["physical_data"].get("schedule", "не указана")
+    await update.message.reply_text(
+        f"Текущая частота: {current_schedule} раз/неделю\n\nСколько раз в неделю сможешь посещать зал (1-7)?"
+    )
+
+@_requires_profile
+async def _handle_edit_restrictions_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_restrictions")
+    current_restrictions = data["physical_data"].get("restrictions", "нет")
+    await update.message.reply_text(
+        f"Текущие ограничения: {current_restrictions}\n\nОпиши новые ограничения по здоровью или предпочтения в тренировках (или напиши 'нет'):"
+    )
 
-    muscle_groups_map = {
-        "🦵 Упор на ноги": "ноги",
-        "🍑 Упор на ягодицы": "ягодицы",
-        "🔙 Упор на спину": "спина",
-        "💪 Упор на плечи и руки": "плечи и руки",
-        "🎲 Сбалансированная программа": "все группы мышц сбалансированно",
+@_requires_profile
+async def _handle_edit_level_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_level")
+    current_level = data["physical_data"].get("level", "не указан")
+    await update.message.reply_text(
+        f"Текущий уровень: {current_level}\n\nВыбери новый уровень подготовки:",
+        reply_markup=LEVEL_KEYBOARD,
+    )
+
+@_requires_profile
+async def _handle_edit_muscle_group_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    user_states[user_id] = UserState("editing_muscle_group")
+    muscle_group_display = {
+        "ноги": "🦵 Ноги",
+        "ягодицы": "🍑 Ягодицы",
+        "спина": "🔙 Спина",
+        "плечи и руки": "💪 Плечи и руки",
+        "сбалансированно": "🎲 Сбалансированно"
     }
+    current_group = data["physical_data"].get("preferred_muscle_group", "не указан")
+    display_group = muscle_group_display.get(current_group, current_group)
+    await update.message.reply_text(
+        f"Текущий акцент: {display_group}\n\nВыбери новый акцент на группу мышц:",
+        reply_markup=MUSCLE_GROUPS_KEYBOARD,
+    )
+
+
+# ---- кнопки стиля программы (VARIATIONS_KEYBOARD) ----
+
+async def _handle_variation_button(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, data: dict, state: UserState):
+    text = (update.message.text or "").strip()
+    name = (data.get("physical_data") or {}).get("name")
+
+    if await _reject_if_busy(update, user_id):
+        return
+
+    # Rate limiting check
+    current_time = time.time()
+    last_time = last_generation_time.get(user_id, 0)
+    time_since_last = current_time - last_time
     
-    if text in muscle_groups_map and state.get("mode") not in ["awaiting_muscle_group", "editing_muscle_group"]:
-        user_states[user_id] = {
-            "mode": "choosing_variation", 
-            "step": 0, 
-            "data": {"muscle_group": muscle_groups_map[text]}
-        }
+    if time_since_last < GENERATION_COOLDOWN:
+        wait_time = int(GENERATION_COOLDOWN - time_since_last)
         await update.message.reply_text(
-            f"Супер! Программа с акцентом на {muscle_groups_map[text]}.\n\nТеперь выбери стиль тренировок ⬇️",
-            reply_markup=VARIATIONS_KEYBOARD
+            f"⏳ Подожди ещё {wait_time} секунд перед следующей генерацией.\n\n"
+            "Это защита от перегрузки 😊"
         )
         return
-
-    variation_map = {
-        "💪 Больше базовых": "Сделай акцент на базовые многосуставные упражнения (приседания, становая, жимы, подтягивания и тому подобные базовые силовые упражнения для тренажерного зала).",
-        "🎯 Больше изоляции": "Добавь больше изолирующих упражнений для проработки отдельных мышечных групп.",
-        "🏋️ Акцент на силу": "Программа с акцентом на развитие силы: меньше повторений (4-6), больше отдыха, тяжелые веса.",
-        "⚡ Акцент на выносливость": "Программа с акцентом на выносливость: больше повторений (15-20), меньше отдыха, умеренные веса.",
-        "🎲 Случайная вариация": "Сделай максимально разнообразную и нестандартную программу, используй креативные упражнения.",
-    }
     
-    if text in variation_map:
-        # Rate limiting check
-        current_time = time.time()
-        last_time = last_generation_time.get(user_id, 0)
-        time_since_last = current_time - last_time
-        
-        if time_since_last < GENERATION_COOLDOWN:
-            wait_time = int(GENERATION_COOLDOWN - time_since_last)
-            await update.message.reply_text(
-                f"⏳ Подожди ещё {wait_time} секунд перед следующей генерацией.\n\n"
-                "Это защита от перегрузки 😊"
-            )
-            return
-        
-        muscle_group = state.get("data", {}).get("muscle_group", "")
-        
-        logger.info(f"User {user_id} ({name}) requested program variation: {text}, muscle_group: {muscle_group}")
-        
-        progress_msg = await update.message.reply_text("⏳ Генерирую программу...")
-        start_time = time.time()
-        
+    muscle_group = state.data.get("muscle_group", "")
+    
+    logger.info(f"User {user_id} ({name}) requested program variation: {text}, muscle_group: {muscle_group}")
+    
+    variation = VARIATION_PROMPTS[text]
+    # добавляем акцент на группу мышц, если выбрана
+    if muscle_group:
+        variation += f" Сделай ОСОБЫЙ АКЦЕНТ на {muscle_group}. Включи больше упражнений для этой группы мышц."
+    
+    # очищаем состояние сразу: пока идёт генерация, пользователь может жать другие кнопки
+    user_states.pop(user_id, None)
+    
+    progress_msg = await update.message.reply_text("⏳ Генерирую программу...")
+    
+    # генерация долгая — отпускаем обработчик, результат пришлём из фоновой задачи
+    _BUSY_USERS.add(user_id)
+    _spawn(_generate_variation(update, user_id, variation, progress_msg, current_time))
+
+
+async def _generate_variation(update: Update, user_id: int, variation: str, progress_msg, requested_at: float):
+    """Фоновая генерация вариации программы и отправка результата."""
+    start_time = time.time()
+    try:
         try:
-            agent = FitnessAgent(token=os.getenv("GIGACHAT_TOKEN"), user_id=user_id)
-            variation = variation_map[text]
-            
-            # добавляем акцент на группу мышц, если выбрана
-            if muscle_group:
-                variation += f" Сделай ОСОБЫЙ АКЦЕНТ на {muscle_group}. Включи больше упражнений для этой группы мышц."
-            
+            agent = _get_agent(user_id)
             # генерация с вариацией
-            plan = await agent.get_program(variation)
+            plan = await _with_typing(update.effective_chat, agent.get_program(variation))
             
             generation_time = time.time() - start_time
             logger.info(f"Program generated for user {user_id} in {generation_time:.2f}s")
@@ -391,124 +958,110 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await progress_msg.edit_text("✨ Программа готова!")
             
             # обновляем время последней генерации
-            last_generation_time[user_id] = current_time
+            last_generation_time[user_id] = requested_at
             
         except Exception as e:
             logger.exception(f"Error generating program for user {user_id}")
             
-            # различные типы ошибок
-            error_msg = "❌ Не получилось сгенерировать программу.\n\n"
-            
-            if "timeout" in str(e).lower():
-                error_msg += "⏱️ Сервер не ответил вовремя. Попробуй ещё раз через минуту."
-            elif "connection" in str(e).lower():
-                error_msg += "🌐 Проблемы с подключением к серверу. Попробуй позже."
-            elif "unauthorized" in str(e).lower() or "403" in str(e):
-                error_msg += "🔒 Проблема с авторизацией. Свяжись с администратором."
-            else:
-                error_msg += f"Попробуй ещё раз позже.\n\nТехническая информация: {str(e)[:100]}"
-            
-            await progress_msg.edit_text(error_msg)
+            await progress_msg.edit_text(
+                _error_text(e, "❌ Не получилось сгенерировать программу.\n\n", PROGRAM_ERROR_MSGS)
+            )
             return
         
-        plan = _sanitize_for_tg(plan)
-        LAST_REPLIES[user_id] = plan
-        set_last_reply(user_id, plan)
-        
-        # очищаем состояние после генерации
-        user_states.pop(user_id, None)
-        
-        # логируем успешную отправку
-        logger.info(f"Program sent to user {user_id}, length: {len(plan)} chars")
-        
-        await _safe_send(update.effective_chat, plan, use_markdown=True)
-        await _send_main_menu(update)
+        await _deliver_reply(update, user_id, plan, "Program")
+    finally:
+        _BUSY_USERS.discard(user_id)
+
+
+_MENU_HANDLERS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "❓ Задать вопрос AI-тренеру": _handle_qa_button,
+    "🎯 Изменить цель": _handle_change_goal_button,
+    "📋 Моя анкета": _handle_profile_button,
+    "⚙️ Изменить параметры": _handle_edit_params_button,
+    "🔁 Начать заново": _handle_restart_button,
+    "👤 Имя": _handle_edit_name_button,
+    "🔢 Возраст": _handle_edit_age_button,
+    "⚖️ Текущий вес": _handle_edit_weight_button,
+    "🎯 Желаемый вес": _handle_edit_goal_weight_button,
+    "📈 Частота тренировок": _handle_edit_schedule_button,
+    "🏋️ Уровень подготовки": _handle_edit_level_button,
+    "💪 Акцент на мышцы": _handle_edit_muscle_group_button,
+    "⚠️ Ограничения / предпочтения": _handle_edit_restrictions_button,
+    **{label: _handle_variation_button for label in VARIATION_PROMPTS},
+}
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message:
         return
 
-    if text == "🔁 Начать заново":
-        logger.info(f"User {user_id} ({name}) restarting registration")
-        
-        # полный сброс: имя, анкета, история, последняя программа/ответ
-        data["physical_data"] = {}                 # <- имя тоже очищаем
-        data["physical_data_completed"] = False
-        data["history"] = []
-        data["last_program"] = None
-        data["last_reply"] = None
-        save_user_data(user_id, data)
-
-        # сбрасываем runtime-состояние и начинаем заново с вопроса про имя
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
-        await update.message.reply_text("Заполним анкету заново 📝 Как тебя зовут?")
+    user_id: int = update.effective_user.id
+    # сообщения одного пользователя обрабатываем строго по очереди
+    async with lock_for(user_id):
+        await _handle_user_message(update, context, user_id)
+
+
+async def _handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    text = (update.message.text or "").strip()
+    await user_states.load(user_id)
+
+    # кнопка не ждёт debounce: накопленный до неё текст отправляем сразу
+    if user_id in _DEBOUNCE_TIMERS and (text in _STATELESS_HANDLERS or text in _MENU_HANDLERS):
+        _flush_debounced(user_id)
+
+    # кнопки, которым не нужна анкета, — без чтения файла пользователя
+    stateless = _STATELESS_HANDLERS.get(text)
+    if stateless is not None:
+        await stateless(update, context, user_id)
         return
 
-    if not completed and state.get("mode") is None:
-        if not name:
-            user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
-            await update.message.reply_text("Как тебя зовут?")
-            return
-        # если имя уже есть, добавляем его в state["data"]
-        user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
+    # текущие данные пользователя
+    data = await load_cached(str(user_id))
+    phys = data.get("physical_data") or {}
+    name = phys.get("name")
+    completed = bool(data.get("physical_data_completed"))
+    state = user_states.get(user_id, _DEFAULT_STATE)
+    
+    logger.debug(f"handle_message - user_id: {user_id}, text: {text[:50]}, state.mode: {state.mode}, completed: {completed}")
+
+    # кнопки меню, параметров и стилей программы — через таблицу обработчиков
+    handler = _MENU_HANDLERS.get(text)
+    if handler is not None:
+        await handler(update, context, user_id, data, state)
+        return
+
+    if text in PROGRAM_MUSCLE_GROUPS and state.mode not in ("awaiting_muscle_group", "editing_muscle_group"):
+        user_states[user_id] = UserState("choosing_variation", data={"muscle_group": PROGRAM_MUSCLE_GROUPS[text]})
         await update.message.reply_text(
-            f"{name}, выбери свою цель тренировок ⬇️",
-            reply_markup=GOAL_KEYBOARD,
+            f"Супер! Программа с акцентом на {PROGRAM_MUSCLE_GROUPS[text]}.\n\nТеперь выбери стиль тренировок ⬇️",
+            reply_markup=VARIATIONS_KEYBOARD
         )
         return
 
-    if text == "❓ Задать вопрос AI-тренеру":
-        user_states[user_id] = {"mode": "qa", "step": 0, "data": {}}
-        await update.message.reply_text("Задай вопрос по тренировкам/питанию ✍🏼")
-        logger.info(f"User {user_id} ({name}) entered Q&A mode")
+    if not completed and state.mode is None:
+        await _ask_registration(update, user_id, name)
         return
 
-    if state.get("mode") == "qa":
-        logger.info(f"User {user_id} ({name}) asked: {text[:100]}")
-        
-        progress_msg = await update.message.reply_text("⏳ Думаю над ответом...")
-        start_time = time.time()
-        
-        try:
-            agent = FitnessAgent(token=os.getenv("GIGACHAT_TOKEN"), user_id=user_id)
-            answer = await agent.get_answer(text)
-            
-            answer_time = time.time() - start_time
-            logger.info(f"Answer generated for user {user_id} in {answer_time:.2f}s")
-            
-            await progress_msg.delete()
-        except Exception as e:
-            logger.exception(f"Error generating answer for user {user_id}")
-            
-            error_msg = "❌ Не удалось получить ответ.\n\n"
-            
-            if "timeout" in str(e).lower():
-                error_msg += "⏱️ Сервер не ответил вовремя. Попробуй переформулировать вопрос."
-            elif "connection" in str(e).lower():
-                error_msg += "🌐 Проблемы с подключением. Попробуй позже."
-            else:
-                error_msg += "Попробуй задать вопрос ещё раз."
-            
-            await progress_msg.edit_text(error_msg)
+    if state.mode == "qa":
+        # агент пользователя занят фоновой генерацией программы
+        if await _reject_if_busy(update, user_id):
             return
-        
-        answer = _sanitize_for_tg(answer)
-        LAST_REPLIES[user_id] = answer
-        set_last_reply(user_id, answer)
-        
-        logger.info(f"Answer sent to user {user_id}, length: {len(answer)} chars")
-        
-        await _safe_send(update.effective_chat, answer, use_markdown=True)
+        logger.info(f"User {user_id} ({name}) asked: {text[:100]}")
+        # вопрос, разбитый на несколько сообщений подряд, уходит в модель одним запросом
+        _debounce_text(user_id, text, lambda joined: _answer_question(update, user_id, joined))
         return
 
     # имя
-    if state.get("mode") == "awaiting_name":
+    if state.mode == "awaiting_name":
         if not text:
             await update.message.reply_text("Напиши, пожалуйста, имя.")
             return
         normalized_name = _normalize_name(text)
         phys["name"] = normalized_name
         data["physical_data"] = phys
-        save_user_data(user_id, data)
-        # добавляем имя в state["data"], чтобы оно попало в финальное сохранение
-        user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": normalized_name}}
+        save_cached(str(user_id), data)
+        # добавляем имя в state.data, чтобы оно попало в финальное сохранение
+        user_states[user_id] = UserState("awaiting_goal", data={"name": normalized_name})
         await update.message.reply_text(
             f"{normalized_name}, выбери свою цель тренировок ⬇️",
             reply_markup=GOAL_KEYBOARD,
@@ -516,14 +1069,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # цель
-    if state.get("mode") == "awaiting_goal":
+    if state.mode == "awaiting_goal":
         if text in GOAL_MAPPING:
             # цель выбрана — идём дальше к полу, сохраняем имя из предыдущего шага
-            user_states[user_id] = {
-                "mode": "awaiting_gender", 
-                "step": 0, 
-                "data": {**state["data"], "target": GOAL_MAPPING[text]}
-            }
+            user_states[user_id] = UserState("awaiting_gender", data={**state.data, "target": GOAL_MAPPING[text]})
             await update.message.reply_text("Укажи свой пол:", reply_markup=GENDER_KEYBOARD)
             return
 
@@ -531,86 +1080,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, выбери цель кнопкой ниже:", reply_markup=GOAL_KEYBOARD)
         return
 
-    # обработчики редактирования параметров
-    if text == "👤 Имя":
-        user_states[user_id] = {"mode": "editing_name", "step": 0, "data": {}}
-        current_name = phys.get("name", "не указано")
-        await update.message.reply_text(
-            f"Текущее имя: {current_name}\n\nВведи новое имя:"
-        )
-        return
-
-    if text == "🔢 Возраст":
-        user_states[user_id] = {"mode": "editing_age", "step": 0, "data": {}}
-        current_age = phys.get("age", "не указан")
-        await update.message.reply_text(
-            f"Текущий возраст: {current_age} лет\n\nВведи новый возраст (10-100 лет):"
-        )
-        return
-
-    if text == "⚖️ Текущий вес":
-        user_states[user_id] = {"mode": "editing_weight", "step": 0, "data": {}}
-        current_weight = phys.get("weight", "не указан")
-        await update.message.reply_text(
-            f"Текущий вес: {current_weight} кг\n\nВведи новый текущий вес в килограммах (например: 75 или 75.5):"
-        )
-        return
-
-    if text == "🎯 Желаемый вес":
-        user_states[user_id] = {"mode": "editing_goal_weight", "step": 0, "data": {}}
-        current_goal = phys.get("goal", "не указан")
-        await update.message.reply_text(
-            f"Желаемый вес: {current_goal} кг\n\nВведи новый желаемый вес в килограммах (например: 70 или 70.5):"
-        )
-        return
-
-    if text == "📈 Частота тренировок":
-        user_states[user_id] = {"mode": "editing_schedule", "step": 0, "data": {}}
-        current_schedule = phys.get("schedule", "не указана")
-        await update.message.reply_text(
-            f"Текущая частота: {current_schedule} раз/неделю\n\nСколько раз в неделю сможешь посещать зал (1-7)?"
-        )
-        return
-
-    if text == "⚠️ Ограничения / предпочтения":
-        user_states[user_id] = {"mode": "editing_restrictions", "step": 0, "data": {}}
-        current_restrictions = phys.get("restrictions", "нет")
-        await update.message.reply_text(
-            f"Текущие ограничения: {current_restrictions}\n\nОпиши новые ограничения по здоровью или предпочтения в тренировках (или напиши 'нет'):"
-        )
-        return
-
-    if text == "🏋️ Уровень подготовки":
-        user_states[user_id] = {"mode": "editing_level", "step": 0, "data": {}}
-        current_level = phys.get("level", "не указан")
-        await update.message.reply_text(
-            f"Текущий уровень: {current_level}\n\nВыбери новый уровень подготовки:",
-            reply_markup=LEVEL_KEYBOARD,
-        )
-        return
-
-    if text == "💪 Акцент на мышцы":
-        user_states[user_id] = {"mode": "editing_muscle_group", "step": 0, "data": {}}
-        muscle_group_display = {
-            "ноги": "🦵 Ноги",
-            "ягодицы": "🍑 Ягодицы",
-            "спина": "🔙 Спина",
-            "плечи и руки": "💪 Плечи и руки",
-            "сбалансированно": "🎲 Сбалансированно"
-        }
-        current_group = phys.get("preferred_muscle_group", "не указан")
-        display_group = muscle_group_display.get(current_group, current_group)
-        await update.message.reply_text(
-            f"Текущий акцент: {display_group}\n\nВыбери новый акцент на группу мышц:",
-            reply_markup=MUSCLE_GROUPS_KEYBOARD,
-        )
-        return
-
     # изменение цели (после заполнения анкеты)
-    if state.get("mode") == "changing_goal":
+    if state.mode == "changing_goal":
         if text in GOAL_MAPPING:
             # сохраняем новую цель через специальную функцию
-            set_user_goal(user_id, GOAL_MAPPING[text])
+            await set_cached_goal(str(user_id), GOAL_MAPPING[text])
             
             # очищаем состояние
             user_states.pop(user_id, None)
@@ -627,12 +1101,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # обработка ввода нового имени
-    if state.get("mode") == "editing_name":
+    if state.mode == "editing_name":
         new_name = _normalize_name(text)
         if not new_name:
             await update.message.reply_text("❌ Имя не может быть пустым.\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "name", new_name)
+        await update_cached_param(str(user_id), "name", new_name)
         user_states.pop(user_id, None)
         await update.message.reply_text(
             f"✅ Имя успешно обновлено: {new_name}",
@@ -640,83 +1114,32 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # обработка ввода нового возраста
-    if state.get("mode") == "editing_age":
-        valid, value, error = validate_age(text)
-        if not valid:
-            await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-            return
-        update_user_param(user_id, "age", value)
-        user_states.pop(user_id, None)
-        await update.message.reply_text(
-            f"✅ Возраст успешно обновлён: {value} лет",
-            reply_markup=MAIN_KEYBOARD,
-        )
-        return
-
-    # обработка ввода нового текущего веса
-    if state.get("mode") == "editing_weight":
-        valid, value, error = validate_weight(text)
-        if not valid:
-            await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-            return
-        update_user_param(user_id, "weight", value)
-        user_states.pop(user_id, None)
-        await update.message.reply_text(
-            f"✅ Текущий вес успешно обновлён: {value} кг",
-            reply_markup=MAIN_KEYBOARD,
-        )
-        return
-
-    # обработка ввода нового желаемого веса
-    if state.get("mode") == "editing_goal_weight":
-        valid, value, error = validate_weight(text)
+    # обработка ввода числовых полей и ограничений
+    edit_field = EDIT_FIELDS.get(state.mode)
+    if edit_field is not None:
+        param, done_text = edit_field
+        valid, value, error = FIELD_VALIDATORS[param](text)
         if not valid:
             await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "goal", value)
+        await update_cached_param(str(user_id), param, value)
         user_states.pop(user_id, None)
         await update.message.reply_text(
-            f"✅ Желаемый вес успешно обновлён: {value} кг",
-            reply_markup=MAIN_KEYBOARD,
-        )
-        return
-
-    # обработка ввода новой частоты
-    if state.get("mode") == "editing_schedule":
-        valid, value, error = validate_schedule(text)
-        if not valid:
-            await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-            return
-        update_user_param(user_id, "schedule", value)
-        user_states.pop(user_id, None)
-        await update.message.reply_text(
-            f"✅ Частота тренировок успешно обновлена: {value} раз/неделю",
-            reply_markup=MAIN_KEYBOARD,
-        )
-        return
-
-    # обработка ввода новых ограничений
-    if state.get("mode") == "editing_restrictions":
-        restrictions = text if text.lower() not in ["нет", "no", "-"] else None
-        update_user_param(user_id, "restrictions", restrictions)
-        user_states.pop(user_id, None)
-        await update.message.reply_text(
-            f"✅ Ограничения / предпочтения успешно обновлены: {restrictions or 'нет'}",
+            done_text.format(value=value if value is not None else "нет"),
             reply_markup=MAIN_KEYBOARD,
         )
         return
 
     # обработка выбора нового уровня
-    if state.get("mode") == "editing_level":
-        if text not in LEVEL_CHOICES:
+    if state.mode == "editing_level":
+        level = LEVEL_MAPPING.get(text)
+        if level is None:
             await update.message.reply_text(
                 "Пожалуйста, выбери уровень кнопкой ниже:",
                 reply_markup=LEVEL_KEYBOARD,
             )
             return
-        level = "опытный" if ("Опыт" in text or "🔥" in text) else "начинающий"
-        update_user_param(user_id, "level", level)
+        await update_cached_param(str(user_id), "level", level)
         user_states.pop(user_id, None)
         await update.message.reply_text(
             f"✅ Уровень подготовки успешно обновлён: {level}",
@@ -725,24 +1148,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # обработка изменения акцента на мышечную группу
-    if state.get("mode") == "editing_muscle_group":
-        muscle_groups_map = {
-            "🦵 Упор на ноги": "ноги",
-            "🍑 Упор на ягодицы": "ягодицы",
-            "🔙 Упор на спину": "спина",
-            "💪 Упор на плечи и руки": "плечи и руки",
-            "🎲 Сбалансированная программа": "сбалансированно",
-        }
-        
-        if text not in muscle_groups_map:
+    if state.mode == "editing_muscle_group":
+        if text not in MUSCLE_GROUP_MAPPING:
             await update.message.reply_text(
                 "Пожалуйста, выбери группу мышц кнопкой ниже:",
                 reply_markup=MUSCLE_GROUPS_KEYBOARD,
             )
             return
         
-        muscle_group = muscle_groups_map[text]
-        update_user_param(user_id, "preferred_muscle_group", muscle_group)
+        muscle_group = MUSCLE_GROUP_MAPPING[text]
+        await update_cached_param(str(user_id), "preferred_muscle_group", muscle_group)
         user_states.pop(user_id, None)
         await update.message.reply_text(
             f"✅ Акцент на мышцы успешно обновлён: {text}",
@@ -751,7 +1166,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # пол
-    if state.get("mode") == "awaiting_gender":
+    if state.mode == "awaiting_gender":
         g = _normalize_gender(text)
         if not g:
             await update.message.reply_text(
@@ -759,104 +1174,63 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=GENDER_KEYBOARD,
             )
             return
-        st = {"mode": "survey", "step": 2, "data": {**state["data"], "gender": g}}
-        user_states[user_id] = st
-        await update.message.reply_text("Сколько тебе лет?")
+        # step — сколько вопросов опроса уже задано
+        user_states[user_id] = UserState("survey", 1, {**state.data, "gender": g})
+        await update.message.reply_text(SURVEY_TEXTS[0])
         return
 
-    # последовательность вопросов
-    questions = [
-        ("age", "Сколько тебе лет?"),
-        ("height", "Твой рост в сантиметрах?"),
-        ("weight", "Твой текущий вес в килограммах?"),
-        ("goal", "Желаемый вес в килограммах?"),
-        ("restrictions", "Есть ли ограничения по здоровью или предпочтения в тренировках?"),
-        ("schedule", "Сколько раз в неделю можешь посещать тренажёрный зал?"),
-    ]
-
     # основной опрос (возраст → ... → частота)
-    if state.get("mode") == "survey":
-        logger.debug(f"Survey mode - step={state['step']}, current data: {state.get('data', {})}, user text: {text[:50] if text else 'empty'}")
-        
-        # валидация предыдущего ответа (если это не первый вход в опрос)
-        if state["step"] > 1:
-            prev_key = questions[state["step"] - 2][0]
-            logger.debug(f"Validating prev_key={prev_key}, text={text}")
-            
-            # применяем валидацию в зависимости от поля
-            if prev_key == "age":
-                valid, value, error = validate_age(text)
-                if not valid:
-                    await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-                    return
-                state["data"][prev_key] = value
-            elif prev_key == "height":
-                valid, value, error = validate_height(text)
-                if not valid:
-                    await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-                    return
-                state["data"][prev_key] = value
-            elif prev_key == "weight":
-                valid, value, error = validate_weight(text)
-                if not valid:
-                    await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-                    return
-                state["data"][prev_key] = value
-            elif prev_key == "goal":
-                valid, value, error = validate_weight(text)
-                if not valid:
-                    await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-                    return
-                state["data"][prev_key] = value
-            elif prev_key == "restrictions":
-                # для ограничений валидация не нужна, принимаем любой текст
-                restrictions = text if text.lower() not in ["нет", "no", "-"] else None
-                state["data"][prev_key] = restrictions
-            elif prev_key == "schedule":
-                valid, value, error = validate_schedule(text)
-                if not valid:
-                    await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
-                    return
-                state["data"][prev_key] = value
-            else:
-                state["data"][prev_key] = text
-            
-            logger.debug(f"After validation - state[data]: {state['data']}")
-        
+    if state.mode == "survey":
+        logger.debug(f"Survey mode - step={state.step}, current data: {state.data}, user text: {text[:50] if text else 'empty'}")
+
+        # ответ на последний заданный вопрос
+        key = SURVEY_KEYS[state.step - 1]
+        logger.debug(f"Validating key={key}, text={text}")
+
+        # применяем валидацию в зависимости от поля
+        validator = FIELD_VALIDATORS.get(key)
+        if validator is None:
+            state.data[key] = text
+        else:
+            valid, value, error = validator(text)
+            if not valid:
+                await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
+                return
+            state.data[key] = value
+
+        logger.debug(f"After validation - state[data]: {state.data}")
+
         # проверяем: есть ли еще вопросы?
-        if state["step"] <= len(questions):
-            idx = state["step"] - 1
-            _, qtext = questions[idx]
-            # ВАЖНО: сохраняем обновленный state обратно в user_states
-            user_states[user_id] = {"mode": "survey", "step": state["step"] + 1, "data": state["data"]}
+        if state.step < SURVEY_LEN:
+            qtext = SURVEY_TEXTS[state.step]
+            # сдвигаем шаг на месте, без нового объекта; присваивание нужно,
+            # чтобы состояние записалось в анкету
+            state.step += 1
+            user_states[user_id] = state
             logger.debug(f"Moving to next question, saved state: {user_states[user_id]}")
             await update.message.reply_text(qtext)
             return
         
         # все вопросы пройдены → переход к выбору уровня подготовки
-        logger.debug(f"Survey completed - state[data]: {state['data']}")
-        user_states[user_id] = {"mode": "awaiting_level", "step": 0, "data": state["data"]}
+        logger.debug(f"Survey completed - state[data]: {state.data}")
+        user_states[user_id] = UserState("awaiting_level", data=state.data)
         await update.message.reply_text("Выбери свой уровень подготовки:", reply_markup=LEVEL_KEYBOARD)
         return
 
     # уровень
-    if state.get("mode") == "awaiting_level":
+    if state.mode == "awaiting_level":
         logger.debug(f"awaiting_level triggered - text: {text}, state: {state}")
-        if text not in LEVEL_CHOICES:
+        level = LEVEL_MAPPING.get(text)
+        if level is None:
             await update.message.reply_text(
                 "Пожалуйста, выбери уровень кнопкой ниже:",
                 reply_markup=LEVEL_KEYBOARD,
             )
             return
-        level = "опытный" if ("Опыт" in text or "🔥" in text) else "начинающий"
         logger.debug(f"Level selected: {level}")
         
         # сохраняем уровень и переходим к выбору мышечной группы
-        user_states[user_id] = {
-            "mode": "awaiting_muscle_group", 
-            "step": 0, 
-            "data": {**state["data"], "level": level}
-        }
+        user_states[user_id] = UserState("awaiting_muscle_group", data={**state.data, "level": level})
         
         await update.message.reply_text(
             "Отлично! Теперь выбери, на какую группу мышц хочешь сделать акцент в тренировках ⬇️",
@@ -865,16 +1239,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # выбор мышечной группы (после уровня, перед генерацией первой программы)
-    if state.get("mode") == "awaiting_muscle_group":
-        muscle_groups_map = {
-            "🦵 Упор на ноги": "ноги",
-            "🍑 Упор на ягодицы": "ягодицы",
-            "🔙 Упор на спину": "спина",
-            "💪 Упор на плечи и руки": "плечи и руки",
-            "🎲 Сбалансированная программа": "сбалансированно",
-        }
-        
-        if text not in muscle_groups_map:
+    if state.mode == "awaiting_muscle_group":
+        if text not in MUSCLE_GROUP_MAPPING:
             await update.message.reply_text(
                 "Пожалуйста, выбери группу мышц кнопкой ниже:",
                 reply_markup=MUSCLE_GROUPS_KEYBOARD,
@@ -882,74 +1248,101 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # сохраняем выбранную группу мышц
-        muscle_group = muscle_groups_map[text]
-        finished = {**state["data"], "preferred_muscle_group": muscle_group}
+        muscle_group = MUSCLE_GROUP_MAPPING[text]
+        finished = {**state.data, "preferred_muscle_group": muscle_group}
         user_states.pop(user_id, None)
 
-        logger.debug(f"Before save - state[data]: {state['data']}")
+        logger.debug(f"Before save - state[data]: {state.data}")
         logger.debug(f"Before save - finished: {finished}")
 
         base = data.get("physical_data") or {}
         base.update(finished)
         data["physical_data"] = base
         data["physical_data_completed"] = True
-        save_user_data(user_id, data)
+        save_cached(str(user_id), data)
 
         logger.info(f"User {user_id} ({base.get('name')}) completed registration with muscle group: {muscle_group}")
         logger.debug(f"Saved physical_data: {base}")
 
-        progress_msg = await update.message.reply_text("⏳ Спасибо! Формирую твою персональную программу…")
-        start_time = time.time()
-
-        agent = FitnessAgent(token=os.getenv("GIGACHAT_TOKEN"), user_id=user_id)
+        # та же отметка, что у фоновых генераций: пока идёт первая программа,
+        # вариация или вопрос не запустятся на том же агенте
+        _BUSY_USERS.add(user_id)
         try:
-            plan = await agent.get_program("")
-            
-            generation_time = time.time() - start_time
-            logger.info(f"First program generated for user {user_id} in {generation_time:.2f}s")
-            
-            await progress_msg.edit_text("✨ Программа готова!")
-        except Exception as e:
-            logger.exception(f"Error generating first program for user {user_id}")
+            progress_msg = await update.message.reply_text("⏳ Спасибо! Формирую твою персональную программу…")
+            start_time = time.time()
+
+            agent = _get_agent(user_id)
+            try:
+                plan = await _with_typing(update.effective_chat, agent.get_program(""))
             
-            error_msg = "❌ Не удалось сгенерировать программу.\n\n"
+                generation_time = time.time() - start_time
+                logger.info(f"First program generated for user {user_id} in {generation_time:.2f}s")
             
-            if "timeout" in str(e).lower():
-                error_msg += "⏱️ Сервер не ответил вовремя. Используй кнопку «🆕 Другая программа» чтобы попробовать снова."
-            elif "connection" in str(e).lower():
-                error_msg += "🌐 Проблемы с подключением. Попробуй через минуту кнопкой «🆕 Другая программа»."
-            else:
-                error_msg += "Попробуй через кнопку «🆕 Другая программа» в главном меню."
+                await progress_msg.edit_text("✨ Программа готова!")
+            except Exception as e:
+                logger.exception(f"Error generating first program for user {user_id}")
             
-            await progress_msg.edit_text(error_msg)
-            await _send_main_menu(update)
-            return
+                await progress_msg.edit_text(
+                    _error_text(e, "❌ Не удалось сгенерировать программу.\n\n", FIRST_PROGRAM_ERROR_MSGS)
+                )
+                await _send_main_menu(update)
+                return
 
-        plan = _sanitize_for_tg(plan)
-        LAST_REPLIES[user_id] = plan
-        set_last_reply(user_id, plan)
-        
-        logger.info(f"First program sent to user {user_id}, length: {len(plan)} chars")
-        
-        await _safe_send(update.effective_chat, plan, use_markdown=True)
-        await _send_main_menu(update)
+            await _deliver_reply(update, user_id, plan, "First program")
+        finally:
+            _BUSY_USERS.discard(user_id)
         return
 
     if not completed:
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
+        user_states[user_id] = UserState("awaiting_name")
         await update.message.reply_text("Как тебя зовут?")
         return
 
-    agent = FitnessAgent(token=os.getenv("GIGACHAT_TOKEN"), user_id=user_id)
-    try:
-        plan = await agent.get_program(text)
-    except Exception:
-        logger.exception("Ошибка генерации программы (с пожеланиями)")
-        await update.message.reply_text("Не получилось сгенерировать программу. Попробуй ещё раз.")
+    if await _reject_if_busy(update, user_id):
         return
+    _debounce_text(user_id, text, lambda joined: _program_with_wishes(update, user_id, joined))
+
+
+async def _answer_question(update: Update, user_id: int, text: str):
+    """Ответ на вопрос в режиме Q&A (запускается после debounce, в фоне)."""
+    _BUSY_USERS.add(user_id)
+    try:
+        progress_msg = await update.message.reply_text("⏳ Думаю над ответом...")
+        start_time = time.time()
+        
+        try:
+            agent = _get_agent(user_id)
+            answer = await _with_typing(update.effective_chat, agent.get_answer(text))
+            
+            answer_time = time.time() - start_time
+            logger.info(f"Answer generated for user {user_id} in {answer_time:.2f}s")
+            
+            await progress_msg.delete()
+        except Exception as e:
+            logger.exception(f"Error generating answer for user {user_id}")
+            
+            await progress_msg.edit_text(
+                _error_text(e, "❌ Не удалось получить ответ.\n\n", ANSWER_ERROR_MSGS)
+            )
+            return
+        
+        await _deliver_reply(update, user_id, answer, "Answer", show_menu=False)
+    finally:
+        _BUSY_USERS.discard(user_id)
+
+
+async def _program_with_wishes(update: Update, user_id: int, text: str):
+    """Программа по свободным пожеланиям (запускается после debounce, в фоне)."""
+    _BUSY_USERS.add(user_id)
+    try:
+        agent = _get_agent(user_id)
+        try:
+            plan = await _with_typing(update.effective_chat, agent.get_program(text))
+        except Exception:
+            logger.exception("Ошибка генерации программы (с пожеланиями)")
+            await update.message.reply_text("Не получилось сгенерировать программу. Попробуй ещё раз.")
+            return
 
-    plan = _sanitize_for_tg(plan)
-    LAST_REPLIES[user_id] = plan
-    set_last_reply(user_id, plan)
-    await _safe_send(update.effective_chat, plan, use_markdown=True)
-    await _send_main_menu(update)
+        await _deliver_reply(update, user_id, plan, "Program with wishes")
+    finally:
+        _BUSY_USERS.discard(user_id)
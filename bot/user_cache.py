@@ -0,0 +1,159 @@
+"""
+Кэш анкет для бота поверх app.storage.
+
+Чтение: из памяти, с диска — только при промахе и в отдельном потоке.
+Запись: сразу в кэш, а файл пишется в фоне с небольшой задержкой,
+поэтому несколько правок подряд превращаются в одну запись на диск.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from app.storage import (
+    apply_saved_program,
+    apply_user_goal,
+    apply_user_param,
+    cache_user_data,
+    cache_user_field,
+    flush_user_data,
+    get_cached_user_data,
+    load_user_data,
+)
+
+logger = logging.getLogger("bot.user_cache")
+
+FLUSH_DELAY = 1.0  # секунд копим изменения анкеты перед записью на диск
+
+# user_id -> задача, которая ещё ждёт FLUSH_DELAY (повторный mark_dirty её не плодит)
+_SCHEDULED: Dict[str, asyncio.Task] = {}
+# все фоновые записи -> user_id; держим ссылки, чтобы задачи не собрал GC до завершения
+_PENDING: Dict[asyncio.Task, str] = {}
+# правки полей для анкет, которых ещё нет в кэше: ждут фоновой загрузки с диска
+_PENDING_FIELDS: Dict[str, Dict[str, Any]] = {}
+_LOADS: Dict[str, asyncio.Task] = {}
+
+
+async def load_cached(user_id: str) -> Dict[str, Any]:
+    """Данные пользователя из кэша; при промахе читаем файл в потоке."""
+    data = get_cached_user_data(user_id)
+    if data is None:
+        data = await asyncio.to_thread(load_user_data, user_id)
+        if _apply_pending(user_id):
+            data = get_cached_user_data(user_id) or data
+    return data
+
+
+def mark_dirty(user_id: str, delay: float = FLUSH_DELAY) -> None:
+    """Планирует запись анкеты на диск, если она ещё не запланирована."""
+    if user_id in _SCHEDULED:
+        return
+    task = asyncio.create_task(_debounced_flush(user_id, delay))
+    _SCHEDULED[user_id] = task
+    _PENDING[task] = user_id
+    task.add_done_callback(_on_flush_done)
+
+
+async def _debounced_flush(user_id: str, delay: float) -> None:
+    await asyncio.sleep(delay)
+    # снимаем отметку до записи: правки, пришедшие во время записи, запланируют новую
+    _SCHEDULED.pop(user_id, None)
+    await asyncio.to_thread(flush_user_data, user_id)
+
+
+def save_cached(user_id: str, data: Dict[str, Any]) -> None:
+    """Обновляем кэш сразу, запись на диск уходит в отложенную фоновую задачу."""
+    cache_user_data(user_id, data)
+    mark_dirty(user_id)
+
+
+def _apply_pending(user_id: str) -> bool:
+    """Переносит отложенные правки полей в кэш, если анкета уже там."""
+    fields = _PENDING_FIELDS.get(user_id)
+    if not fields:
+        return False
+    for key, value in list(fields.items()):
+        if not cache_user_field(user_id, key, value, load=False):
+            return False
+        del fields[key]
+    _PENDING_FIELDS.pop(user_id, None)
+    mark_dirty(user_id)
+    return True
+
+
+async def _load_and_apply(user_id: str) -> None:
+    try:
+        await asyncio.to_thread(load_user_data, user_id)
+        _apply_pending(user_id)
+    finally:
+        _LOADS.pop(user_id, None)
+
+
+def _cache_field(user_id: str, key: str, value: Any) -> None:
+    """
+    Поле анкеты: в кэш сразу. Если анкеты в кэше нет, диск на event loop
+    не читаем — правка ждёт фоновой загрузки анкеты.
+    """
+    if user_id not in _PENDING_FIELDS and cache_user_field(user_id, key, value, load=False):
+        mark_dirty(user_id)
+        return
+    _PENDING_FIELDS.setdefault(user_id, {})[key] = value
+    if user_id not in _LOADS:
+        task = asyncio.create_task(_load_and_apply(user_id))
+        _LOADS[user_id] = task
+        task.add_done_callback(_on_flush_done)
+
+
+def save_last_reply(user_id: str, text: str) -> None:
+    """Последний ответ: в кэш сразу, на диск — фоновой записью анкеты."""
+    _cache_field(user_id, "last_reply", text)
+
+
+def save_state(user_id: str, state: Optional[Dict[str, Any]]) -> None:
+    """Состояние сценария: в кэш сразу, на диск — фоновой записью анкеты."""
+    _cache_field(user_id, "state", state)
+
+
+async def update_cached_param(user_id: str, param_name: str, value: Any) -> Dict[str, Any]:
+    """Аналог storage.update_user_param без синхронной записи на диск."""
+    data = apply_user_param(await load_cached(user_id), param_name, value)
+    save_cached(user_id, data)
+    return data
+
+
+async def set_cached_goal(user_id: str, goal: str) -> Dict[str, Any]:
+    """Аналог storage.set_user_goal без синхронной записи на диск."""
+    data = apply_user_goal(await load_cached(user_id), goal)
+    save_cached(user_id, data)
+    return data
+
+
+async def add_cached_saved_program(user_id: str, ts: int, filename: str, file_id: Optional[str] = None) -> None:
+    """Файл в индекс сохранённых программ: в кэш сразу, на диск — фоновой записью анкеты."""
+    save_cached(user_id, apply_saved_program(await load_cached(user_id), ts, filename, file_id))
+
+
+def _on_flush_done(task: asyncio.Task) -> None:
+    _PENDING.pop(task, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background save failed: %s", task.exception())
+
+
+async def drain() -> None:
+    """Сразу пишем всё отложенное (вызывается при остановке бота)."""
+    if _LOADS:
+        # сначала дожидаемся загрузок: они переносят отложенные правки в кэш
+        await asyncio.gather(*list(_LOADS.values()), return_exceptions=True)
+    if not _PENDING:
+        return
+    users = set(_PENDING.values())
+    tasks = list(_PENDING)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _SCHEDULED.clear()
+    await asyncio.gather(
+        *(asyncio.to_thread(flush_user_data, user_id) for user_id in users),
+        return_exceptions=True,
+    )
@@ -1,6 +1,10 @@
 import os
 import logging
 from dotenv import load_dotenv
+
+# .env читаем до импорта app/bot: они берут настройки из окружения при импорте
+load_dotenv()
+
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -10,8 +14,9 @@ from telegram.ext import (
     filters,
 )
 
-from app.storage import load_user_data, save_user_data
-from bot.telegram_bot import user_states, GOAL_KEYBOARD, handle_message
+from bot.telegram_bot import GIGACHAT_TOKEN, UserState, user_states, GOAL_KEYBOARD, handle_message, lock_for
+from bot.sender import SendRateLimiter
+from bot.user_cache import drain, load_cached, save_cached
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -19,7 +24,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger("main")
 
-load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -30,50 +34,74 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
 
-    user_id = str(update.effective_user.id)
-    d = load_user_data(user_id)
-    name = (d.get("physical_data") or {}).get("name")
+    user_id: int = update.effective_user.id
+    # та же блокировка, что у обработчика сообщений: /start не перемешается с ответом на текст
+    async with lock_for(user_id):
+        d = await load_cached(str(user_id))
+        name = (d.get("physical_data") or {}).get("name")
+
+        # мягкий сброс состояния пользователя
+        d["physical_data"] = {"name": name}
+        d["physical_data_completed"] = False
+        d["history"] = []
+        d["last_program"] = None
+        d["last_reply"] = None
+        save_cached(str(user_id), d)
 
-    # мягкий сброс состояния пользователя
-    d["physical_data"] = {"name": name}
-    d["physical_data_completed"] = False
-    d["history"] = []
-    d["last_program"] = None
-    d["last_reply"] = None
-    save_user_data(user_id, d)
+        # чистим runtime-состояние
+        user_states.pop(user_id, None)
 
-    # чистим runtime-состояние
-    user_states.pop(user_id, None)
+        if not name:
+            # начинаем с имени
+            user_states[user_id] = UserState("awaiting_name")
+            await update.message.reply_text(
+                "Привет! Я твой персональный фитнес-тренер GymAiMentor 💪🏼\n"
+                "Помогу составить для тебя программу тренировок и отвечу на любые вопросы.\n"
+                "Let's get it started 🚀 Как тебя зовут?"
+            )
+            return
 
-    if not name:
-        # начинаем с имени
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
+        # имя уже есть — сразу просим цель (ВАЖНО: без лишнего отступа)
+        user_states[user_id] = UserState("awaiting_goal", data={"name": name})
         await update.message.reply_text(
-            "Привет! Я твой персональный фитнес-тренер GymAiMentor 💪🏼\n"
-            "Помогу составить для тебя программу тренировок и отвечу на любые вопросы.\n"
-            "Let's get it started 🚀 Как тебя зовут?"
+            f"{name}, выбери свою цель тренировок ⬇️",
+            reply_markup=GOAL_KEYBOARD,
         )
-        return
-
-    # имя уже есть — сразу просим цель (ВАЖНО: без лишнего отступа)
-    user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
-    await update.message.reply_text(
-        f"{name}, выбери свою цель тренировок ⬇️",
-        reply_markup=GOAL_KEYBOARD,
-    )
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # прокидываем в общий handler — он покажет актуальные кнопки/состояния
     await handle_message(update, context)
 
+async def on_shutdown(app):
+    # дописываем на диск анкеты, сохранение которых ещё идёт в фоне
+    await drain()
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.exception("Unhandled error", exc_info=context.error)
 
 def run_main():
     if not TELEGRAM_TOKEN:
         raise RuntimeError("Переменная окружения TELEGRAM_TOKEN не задана")
+    if not GIGACHAT_TOKEN:
+        # меню и анкета работают и без модели, поэтому не падаем, а предупреждаем
+        logger.warning("GIGACHAT_TOKEN не задан: генерация программ и ответы на вопросы работать не будут")
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        # апдейты разных пользователей обрабатываем параллельно;
+        # порядок внутри одного чата держат блокировки в bot.telegram_bot
+        .concurrent_updates(True)
+        # пул HTTP-соединений к Bot API: при наплыве нажатий запросы не ждут
+        # друг друга, а длинные отправки (документы) не падают по таймауту
+        .connection_pool_size(256)
+        .pool_timeout(30.0)
+        .read_timeout(30.0)
+        .write_timeout(30.0)
+        .rate_limiter(SendRateLimiter())
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("menu", menu))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))